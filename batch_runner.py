@@ -0,0 +1,241 @@
+import heapq
+import itertools
+import json
+import os
+import time
+from threading import Condition, Lock, Thread
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from rich.progress import BarColumn, MofNCompleteColumn, Progress, TextColumn, TimeElapsedColumn, TimeRemainingColumn
+
+# 不重试的错误（重试也不会成功）
+NON_RETRYABLE_ERRORS = ("认证失败", "请求参数错误")
+
+
+def load_items(input_file: str, default_api: str, default_model: Optional[str]) -> List[Dict]:
+    """
+    读取JSONL格式的批量任务，每行一个对象：
+    {"id": 可选, "prompt": "..." 或 "messages": [...], "api": 可选, "model": 可选, "system": 可选}
+    未提供id时使用行号；格式错误、缺少 prompt/messages 或id重复时抛出 ValueError（注明行号）
+    """
+    items = []
+    seen_ids = set()
+    with open(input_file, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"第{line_no}行不是有效的JSON: {e}")
+            if isinstance(data, str):
+                data = {"prompt": data}
+            if not isinstance(data, dict):
+                raise ValueError(f"第{line_no}行应为对象或字符串")
+            prompt, messages = data.get("prompt"), data.get("messages")
+            if not (isinstance(prompt, str) and prompt) and not (isinstance(messages, list) and messages):
+                raise ValueError(f"第{line_no}行缺少 prompt 或 messages")
+            data.setdefault("id", str(line_no))
+            data["id"] = str(data["id"])
+            if data["id"] in seen_ids:
+                raise ValueError(f"第{line_no}行的id重复: {data['id']}")
+            seen_ids.add(data["id"])
+            data.setdefault("api", default_api)
+            if default_model and not data.get("model"):
+                data["model"] = default_model
+            items.append(data)
+    return items
+
+
+def load_checkpoint(checkpoint_file: str) -> Set[str]:
+    """读取已完成的任务id"""
+    if not os.path.exists(checkpoint_file):
+        return set()
+    with open(checkpoint_file, 'r', encoding='utf-8') as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+class RateLimiter:
+    """令牌桶限速：每分钟最多 rpm 次请求，0 表示不限制"""
+    def __init__(self, rpm: int):
+        self.interval = 60.0 / rpm if rpm > 0 else 0.0
+        self.next_time = 0.0
+        self.lock = Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ProviderQueue:
+    """单个API的待处理队列，按可执行时间排序；重试的任务延后执行，不阻塞其他任务"""
+    def __init__(self, concurrency: int, rpm: int):
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(rpm)
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = Condition()
+        self.remaining = 0
+
+    def put(self, item: Dict, ready_at: float = 0.0, new: bool = True):
+        with self.condition:
+            heapq.heappush(self.heap, (ready_at, next(self.counter), item))
+            if new:
+                self.remaining += 1
+            self.condition.notify()
+
+    def get(self) -> Optional[Dict]:
+        """取出下一个可执行的任务，全部完成后返回None"""
+        with self.condition:
+            while True:
+                if self.remaining == 0:
+                    return None
+                if self.heap:
+                    wait = self.heap[0][0] - time.time()
+                    if wait <= 0:
+                        return heapq.heappop(self.heap)[2]
+                    self.condition.wait(wait)
+                else:
+                    self.condition.wait()
+
+    def done(self):
+        with self.condition:
+            self.remaining -= 1
+            self.condition.notify_all()
+
+
+class BatchRunner:
+    def __init__(self, output_file: str, chat_fn: Callable[[Dict], Dict],
+                 concurrency: Dict[str, int], rpm: Dict[str, int], max_retries: int = 3):
+        """
+        初始化批量任务执行器
+        :param output_file: 成功结果输出文件（JSONL，追加写入，每个id只有一条），检查点文件为 output_file + ".ckpt"，
+                            本次运行最终失败的任务写入 output_file + ".failed"（每次运行重新生成），再次运行时会重新处理
+        :param chat_fn: chat_fn(item) -> chat_stream 的返回值，负责实际调用API
+        :param concurrency: 每个API的最大并发数
+        :param rpm: 每个API每分钟最多请求数（0表示不限制）
+        :param max_retries: 失败任务的最大重试次数
+        """
+        self.output_file = output_file
+        self.checkpoint_file = output_file + ".ckpt"
+        self.failed_file = output_file + ".failed"
+        self.chat_fn = chat_fn
+        self.concurrency = concurrency
+        self.rpm = rpm
+        self.max_retries = max_retries
+        self.write_lock = Lock()
+        self.completed_tokens = 0
+        self.failed = 0
+
+    def _write_result(self, result: Dict):
+        """
+        成功结果写入输出文件后再记录检查点，中断后最多重做正在写入的一条
+        最终失败的任务写入失败文件，不记录检查点，再次运行时会重新处理
+        """
+        with self.write_lock:
+            usage = result.get("usage") or {}
+            self.completed_tokens += usage.get("completion_tokens", 0)
+            if result.get("error"):
+                self.failed += 1
+                with open(self.failed_file, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(result, ensure_ascii=False) + "\n")
+                return
+            with open(self.output_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+            with open(self.checkpoint_file, 'a', encoding='utf-8') as f:
+                f.write(result["id"] + "\n")
+
+    def _worker(self, queue: ProviderQueue, on_done: Callable[[], None]):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            queue.rate_limiter.acquire()
+            attempt = item.get("_attempt", 0) + 1
+            start = time.time()
+            try:
+                response = self.chat_fn(item)
+            except Exception as e:
+                response = {"content": "", "error": str(e)}
+            error = response.get("error") or (None if response.get("content") else "未返回回答内容")
+            if error and attempt <= self.max_retries and not error.startswith(NON_RETRYABLE_ERRORS):
+                # 指数退避后重新排队，期间该线程继续处理其他任务
+                item["_attempt"] = attempt
+                queue.put(item, ready_at=time.time() + 2 ** attempt, new=False)
+                continue
+            self._write_result({
+                "id": item["id"],
+                "api": item["api"],
+                "model": item.get("model"),
+                "content": response.get("content", ""),
+                "reasoning_content": response.get("reasoning_content", ""),
+                "usage": response.get("usage"),
+                "latency": round(time.time() - start, 3),
+                "attempts": attempt,
+                "error": error,
+            })
+            queue.done()
+            on_done()
+
+    def run(self, items: Iterable[Dict], console=None) -> Dict:
+        """执行全部未完成的任务，返回汇总信息"""
+        items = list(items)
+        done_ids = load_checkpoint(self.checkpoint_file)
+        pending = [item for item in items if item["id"] not in done_ids]
+        skipped = len(items) - len(pending)
+        # 失败文件只记录本次运行的失败任务
+        open(self.failed_file, 'w', encoding='utf-8').close()
+
+        queues: Dict[str, ProviderQueue] = {}
+        for item in pending:
+            api_name = item["api"]
+            if api_name not in queues:
+                queues[api_name] = ProviderQueue(self.concurrency.get(api_name, 1), self.rpm.get(api_name, 0))
+            queues[api_name].put(item)
+
+        start = time.time()
+        progress = Progress(
+            TextColumn("[bold blue]批量处理"),
+            BarColumn(),
+            MofNCompleteColumn(),
+            TextColumn("{task.fields[throughput]}"),
+            TimeElapsedColumn(),
+            TimeRemainingColumn(),
+            console=console
+        )
+        task = progress.add_task("batch", total=len(pending), throughput="")
+        progress_lock = Lock()
+        finished = [0]
+
+        def on_done():
+            with progress_lock:
+                finished[0] += 1
+                elapsed = max(time.time() - start, 1e-6)
+                progress.update(task, advance=1, throughput=(
+                    f"{finished[0] / elapsed:.2f} 条/秒 | {self.completed_tokens / elapsed:.0f} tokens/秒"
+                    f" | 失败 {self.failed}"))
+
+        threads = []
+        with progress:
+            for queue in queues.values():
+                for _ in range(queue.concurrency):
+                    thread = Thread(target=self._worker, args=(queue, on_done), daemon=True)
+                    thread.start()
+                    threads.append(thread)
+            for thread in threads:
+                thread.join()
+
+        return {
+            "total": len(items),
+            "skipped": skipped,
+            "processed": finished[0],
+            "failed": self.failed,
+            "elapsed": round(time.time() - start, 1),
+        }
@@ -0,0 +1,196 @@
+import sys
+import time
+from collections import defaultdict
+from threading import Lock
+from typing import Dict, Optional
+
+# 预热状态的有效期（秒），超时未发送消息则释放已解压的历史
+PREWARM_TTL = 30
+# 同一API两次唤醒连接的最小间隔（秒），需小于HTTP连接池的空闲保持时间（httpx 默认5秒）
+WAKE_INTERVAL = 3
+WAKE_TIMEOUT = 5
+# 同一会话两次预热的最小间隔（秒），不依赖浏览器端的节流
+TYPING_INTERVAL = 1.0
+# 所有会话预热时解压的历史合计占用的内存上限（字节），超出后只唤醒连接不解压
+PREWARM_MAX_BYTES = 32 * 1024 * 1024
+
+
+class WarmState:
+    """单个会话的预热结果"""
+    __slots__ = ('api_name', 'model', 'prepared', 'nbytes', 'trim', 'trim_tokens', 'trim_anchor', 'expires_at')
+
+    def __init__(self, api_name: str, model: str, prepared: Optional[Dict], trim: int, trim_tokens: int,
+                 trim_anchor, expires_at: float):
+        self.api_name = api_name
+        self.model = model
+        self.prepared = prepared  # history.prepare() 的结果，超出内存上限时为None
+        self.nbytes = _prepared_bytes(prepared)
+        self.trim = trim  # 预热时计算的裁剪方案：需要丢弃的消息数
+        self.trim_tokens = trim_tokens  # 这些消息的token数
+        self.trim_anchor = trim_anchor  # 丢弃后保留的第一条消息记录，用于复核方案
+        self.expires_at = expires_at
+
+
+def _prepared_bytes(prepared: Optional[Dict]) -> int:
+    """估算预热时解压出的消息占用的内存字节数"""
+    if not prepared:
+        return 0
+    return sys.getsizeof(prepared) + sum(sys.getsizeof(message["content"]) for _, message in prepared.values())
+
+
+def _new_ttft():
+    return {"warm": {"count": 0, "seconds": 0.0}, "cold": {"count": 0, "seconds": 0.0}}
+
+
+class Prewarmer:
+    def __init__(self, enabled: bool = True, ttl: float = PREWARM_TTL, wake_interval: float = WAKE_INTERVAL,
+                 typing_interval: float = TYPING_INTERVAL, max_bytes: int = PREWARM_MAX_BYTES):
+        """
+        用户输入期间预热请求路径：唤醒空闲的上游连接、提前解压对话历史并计算裁剪方案
+        :param enabled: 为False时忽略预热请求，只统计冷启动的首token时间
+        :param ttl: 预热状态的有效期（秒）
+        :param wake_interval: 同一API两次唤醒连接的最小间隔（秒）
+        :param typing_interval: 同一会话两次预热的最小间隔（秒）
+        :param max_bytes: 所有预热状态中解压的历史合计占用的内存上限（字节）
+        """
+        self.enabled = enabled
+        self.ttl = ttl
+        self.wake_interval = wake_interval
+        self.typing_interval = typing_interval
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.states: Dict[str, WarmState] = {}  # 会话令牌 -> 预热状态
+        self.prepared_bytes = 0  # 所有预热状态中解压的历史合计占用的字节数
+        self.last_typing: Dict[str, float] = {}  # 会话令牌 -> 最近一次接受预热请求的时间
+        self.last_wake: Dict[str, float] = {}  # API -> 最近一次使用或唤醒连接的时间
+        self.counters = {"warmups": 0, "throttled": 0, "over_budget": 0, "wakes": 0, "wake_errors": 0,
+                         "used": 0, "expired": 0}
+        self.ttft = defaultdict(_new_ttft)  # API -> 预热/未预热请求的首token时间累计
+
+    def accept(self, token: str) -> bool:
+        """会话的输入中事件是否需要处理：距上次接受不足 typing_interval 时忽略"""
+        if not self.enabled:
+            return False
+        now = time.time()
+        with self.lock:
+            if now - self.last_typing.get(token, 0) < self.typing_interval:
+                self.counters["throttled"] += 1
+                return False
+            self.last_typing[token] = now
+            return True
+
+    def warm(self, token: str, api_name: str, model: str, client, history, builder):
+        """处理会话的输入中事件（在后台线程中调用，可能发起网络请求）"""
+        if not self.enabled:
+            return
+        now = time.time()
+        records = list(history.records)
+        trim = builder.plan(history)
+        with self.lock:
+            over_budget = self.prepared_bytes >= self.max_bytes
+        state = WarmState(api_name, model, None if over_budget else history.prepare(skip=trim), trim,
+                          sum(r.tokens for r in records[1:1 + trim]),
+                          records[1 + trim] if len(records) > 1 + trim else None, now + self.ttl)
+        with self.lock:
+            old = self.states.get(token)
+            if state.nbytes and self.prepared_bytes - (old.nbytes if old else 0) + state.nbytes > self.max_bytes:
+                # 其他会话同时预热后超出上限：放弃解压结果，仍保留裁剪方案
+                state.prepared, state.nbytes = None, 0
+                over_budget = True
+            if old:
+                self.prepared_bytes -= old.nbytes
+            self.states[token] = state
+            self.prepared_bytes += state.nbytes
+            self.counters["warmups"] += 1
+            if over_budget:
+                self.counters["over_budget"] += 1
+            wake = now - self.last_wake.get(api_name, 0) >= self.wake_interval
+            if wake:
+                self.last_wake[api_name] = now
+        if wake:
+            # 轻量请求，使连接池中保持一条已完成TLS握手的连接
+            try:
+                client.models.list(timeout=WAKE_TIMEOUT)
+                with self.lock:
+                    self.counters["wakes"] += 1
+            except Exception:
+                with self.lock:
+                    self.counters["wake_errors"] += 1
+
+    def take(self, token: str, api_name: str) -> Optional[WarmState]:
+        """取出会话的预热状态（已过期或已切换API时返回None）"""
+        with self.lock:
+            state = self.states.pop(token, None)
+            if state is None:
+                return None
+            self.prepared_bytes -= state.nbytes
+            if state.expires_at < time.time() or state.api_name != api_name:
+                self.counters["expired"] += 1
+                return None
+            self.counters["used"] += 1
+            return state
+
+    def memory_usage(self, token: str) -> int:
+        """会话的预热状态中解压的历史占用的字节数"""
+        with self.lock:
+            state = self.states.get(token)
+            return state.nbytes if state else 0
+
+    def release(self, keep_token: Optional[str] = None) -> int:
+        """丢弃除 keep_token 外所有预热状态中解压的历史（保留裁剪方案），返回释放的字节数"""
+        freed = 0
+        with self.lock:
+            for token, state in self.states.items():
+                if token != keep_token and state.nbytes:
+                    freed += state.nbytes
+                    state.prepared, state.nbytes = None, 0
+            self.prepared_bytes -= freed
+        return freed
+
+    def mark_used(self, api_name: str):
+        """请求结束后连接仍在连接池中，短时间内无需再次唤醒"""
+        with self.lock:
+            self.last_wake[api_name] = time.time()
+
+    def record_ttft(self, api_name: str, warm: bool, ttft: Optional[float]):
+        """记录一次请求的首token时间"""
+        if ttft is None:
+            return
+        with self.lock:
+            counter = self.ttft[api_name]["warm" if warm else "cold"]
+            counter["count"] += 1
+            counter["seconds"] += ttft
+
+    def purge_expired(self):
+        """释放过期的预热状态"""
+        now = time.time()
+        with self.lock:
+            for token in [t for t, s in self.states.items() if s.expires_at < now]:
+                self.prepared_bytes -= self.states.pop(token).nbytes
+                self.counters["expired"] += 1
+            for token in [t for t, last in self.last_typing.items() if now - last > self.ttl]:
+                del self.last_typing[token]
+
+    def snapshot(self) -> Dict:
+        """预热统计：各API预热/未预热请求的平均首token时间及节省的时间"""
+        with self.lock:
+            apis = {}
+            for api_name, ttft in self.ttft.items():
+                warm_avg = ttft["warm"]["seconds"] / ttft["warm"]["count"] if ttft["warm"]["count"] else None
+                cold_avg = ttft["cold"]["seconds"] / ttft["cold"]["count"] if ttft["cold"]["count"] else None
+                apis[api_name] = {
+                    "warm_requests": ttft["warm"]["count"],
+                    "cold_requests": ttft["cold"]["count"],
+                    "warm_ttft": round(warm_avg, 3) if warm_avg is not None else None,
+                    "cold_ttft": round(cold_avg, 3) if cold_avg is not None else None,
+                    "ttft_saved": round(cold_avg - warm_avg, 3) if warm_avg is not None and cold_avg is not None else None,
+                }
+            return {
+                "enabled": self.enabled,
+                "ttl": self.ttl,
+                "active_states": len(self.states),
+                "prepared_bytes": self.prepared_bytes,
+                "max_bytes": self.max_bytes,
+                **self.counters,
+                "apis": apis,
+            }
@@ -0,0 +1,79 @@
+from typing import Dict, List, Optional
+
+from session_history import SessionHistory
+
+# 对话历史的token上限，超出后从最早的对话开始丢弃
+PROMPT_TOKEN_BUDGET = 48000
+# 超出上限时一次性裁剪到上限的该比例，之后较长时间内前缀保持不变
+TRIM_KEEP_RATIO = 0.5
+
+
+def plan_trim(history: SessionHistory, token_budget: int = PROMPT_TOKEN_BUDGET,
+              keep_ratio: float = TRIM_KEEP_RATIO) -> int:
+    """
+    计算需要从最早处丢弃的消息数，未超出上限时返回0
+    按整轮丢弃（保留部分总是从用户消息开始），并且不会丢弃最后一条消息
+    """
+    if history.token_count <= token_budget:
+        return 0
+    target = int(token_budget * keep_ratio)
+    records = history.records
+    total = history.token_count
+    last = len(records) - 1
+    index = 1
+    while index < last and total > target:
+        total -= records[index].tokens
+        index += 1
+        while index < last and records[index].role != "user":
+            total -= records[index].tokens
+            index += 1
+    return index - 1
+
+
+class PromptBuilder:
+    """
+    构造发送给API的消息列表，尽量保持请求前缀逐字节不变以命中API的前缀缓存：
+    系统提示词固定、对话只追加、超出上限时一次裁剪一大段而不是每轮丢弃一条
+    """
+    def __init__(self, token_budget: int = PROMPT_TOKEN_BUDGET, keep_ratio: float = TRIM_KEEP_RATIO):
+        self.token_budget = token_budget
+        self.keep_ratio = keep_ratio
+        self.trim_count = 0
+
+    def add_user_message(self, history: SessionHistory, content: str):
+        """追加用户消息；上一轮提问未得到回复时先将其丢弃，保持用户/助手交替"""
+        history.discard_unanswered()
+        history.append("user", content)
+
+    def plan(self, history: SessionHistory) -> int:
+        """只计算裁剪方案（需要丢弃的消息数），不修改历史"""
+        return plan_trim(history, self.token_budget, self.keep_ratio)
+
+    def recheck(self, history: SessionHistory, trim: int, trim_tokens: int, anchor) -> int:
+        """
+        复核预热时计算的裁剪方案（之后历史末尾可能追加了新消息）
+        历史开头未变且按原方案丢弃后不超过目标时直接沿用，否则重新计算
+        :param trim: 预热时计划丢弃的消息数
+        :param trim_tokens: 这些消息的token数
+        :param anchor: 预热时丢弃后保留的第一条消息记录
+        """
+        if history.token_count <= self.token_budget:
+            return 0
+        records = history.records
+        if (trim and len(records) > trim + 1 and records[trim + 1] is anchor and
+                history.token_count - trim_tokens <= int(self.token_budget * self.keep_ratio)):
+            return trim
+        return self.plan(history)
+
+    def build(self, history: SessionHistory, prepared: Optional[Dict] = None,
+              trim: Optional[int] = None) -> List[Dict[str, str]]:
+        """
+        必要时裁剪历史，返回本次请求的消息列表
+        :param prepared: 预热时 history.prepare() 的结果，其中的消息无需再次解压
+        :param trim: 已复核的裁剪方案（见 recheck），为空时重新计算
+        """
+        drop = self.plan(history) if trim is None else trim
+        if drop:
+            history.drop_oldest(drop)
+            self.trim_count += 1
+        return history.as_messages(prepared)
@@ -0,0 +1,166 @@
+import csv
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Tuple
+
+from rich.live import Live
+from rich.panel import Panel
+from rich.table import Table
+from rich.text import Text
+
+# 并排显示时每个面板保留的最近行数
+PANEL_TAIL_LINES = 12
+
+# 对比结果的字段（写入CSV时的列顺序）
+RESULT_FIELDS = ("time", "api", "model", "ttft", "latency", "completion_tokens", "reasoning_tokens",
+                 "tokens_per_second", "reasoning_share", "usage_estimated", "error")
+
+
+class PairPrinter:
+    """对比模式下单个API/模型的输出收集器，记录首个token时间并转发内容"""
+    def __init__(self, key: str, on_delta: Optional[Callable[[str, str, bool], None]] = None):
+        self.key = key
+        self.on_delta = on_delta
+        self.first_token_at = None
+
+    def stream_print(self, content, is_reasoning=False):
+        if not content:
+            return
+        if self.first_token_at is None:
+            self.first_token_at = time.time()
+        if self.on_delta:
+            self.on_delta(self.key, content, is_reasoning)
+
+
+def pair_key(api_name: str, model: str) -> str:
+    return f"{api_name}/{model}"
+
+
+def _summarize(api_name: str, model: str, start: float, printer: PairPrinter, response: Dict) -> Dict:
+    """根据一次请求的耗时和用量计算对比指标"""
+    end = time.time()
+    usage = response.get("usage") or {}
+    completion_tokens = usage.get("completion_tokens", 0)
+    reasoning_tokens = usage.get("reasoning_tokens", 0)
+    ttft = printer.first_token_at - start if printer.first_token_at else None
+    # 吞吐按首个token之后的生成时间计算，排除排队和首包等待
+    generation_time = end - (printer.first_token_at or start)
+    error = response.get("error")
+    if not error and not response.get("content"):
+        error = "未返回回答内容"
+    return {
+        "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "api": api_name,
+        "model": model,
+        "ttft": round(ttft, 3) if ttft is not None else None,
+        "latency": round(end - start, 3),
+        "completion_tokens": completion_tokens,
+        "reasoning_tokens": reasoning_tokens,
+        "tokens_per_second": round(completion_tokens / generation_time, 1) if generation_time > 0 else None,
+        "reasoning_share": round(reasoning_tokens / completion_tokens, 3) if completion_tokens else 0.0,
+        "usage_estimated": usage.get("estimated", True),
+        "error": error,
+    }
+
+
+def run_compare(pairs: List[Tuple[str, str]], messages: List[Dict[str, str]],
+                chat_fn: Callable[[str, str, List[Dict[str, str]], PairPrinter], Dict],
+                on_delta: Optional[Callable[[str, str, bool], None]] = None) -> List[Dict]:
+    """
+    将同一组消息同时发送给多个API/模型，返回每一组的对比指标（顺序与pairs一致）
+    :param chat_fn: chat_fn(api_name, model, messages, printer) -> chat_stream 的返回值
+    :param on_delta: on_delta(pair_key, content, is_reasoning)，用于流式展示各自的回答
+    """
+    def run_one(pair):
+        api_name, model = pair
+        printer = PairPrinter(pair_key(api_name, model), on_delta)
+        start = time.time()
+        try:
+            response = chat_fn(api_name, model, messages, printer)
+        except Exception as e:
+            response = {"content": "", "error": str(e)}
+        return _summarize(api_name, model, start, printer, response)
+
+    if not pairs:
+        return []
+    with ThreadPoolExecutor(max_workers=len(pairs)) as executor:
+        return list(executor.map(run_one, pairs))
+
+
+def build_table(results: List[Dict]) -> Table:
+    """生成对比结果表格"""
+    table = Table(title="API/模型对比结果")
+    for column in ("API/模型", "首token(s)", "总耗时(s)", "tokens/s", "思考占比", "错误"):
+        table.add_column(column)
+    for r in results:
+        table.add_row(
+            pair_key(r["api"], r["model"]),
+            "-" if r["ttft"] is None else f"{r['ttft']:.2f}",
+            f"{r['latency']:.2f}",
+            "-" if r["tokens_per_second"] is None else f"{r['tokens_per_second']:.1f}"
+            + ("*" if r["usage_estimated"] else ""),
+            f"{r['reasoning_share']:.0%}",
+            Text(r["error"] or "", style="red")
+        )
+    return table
+
+
+def append_results(path: str, results: List[Dict]):
+    """将对比结果追加到本地文件，扩展名为 .csv 时写CSV，否则写JSONL"""
+    try:
+        if path.endswith(".csv"):
+            write_header = not os.path.exists(path)
+            with open(path, 'a', encoding='utf-8', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+                if write_header:
+                    writer.writeheader()
+                writer.writerows(results)
+        else:
+            with open(path, 'a', encoding='utf-8') as f:
+                for r in results:
+                    f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    except Exception as e:
+        print(f"保存对比结果失败: {str(e)}")
+
+
+class CompareView:
+    """终端中并排实时显示各API/模型的回答（固定帧率重绘）"""
+    def __init__(self, console, keys: List[str], refresh_per_second: int = 8):
+        self.keys = keys
+        self.texts = {key: [] for key in keys}
+        self.reasoning = {key: [] for key in keys}
+        self.lock = Lock()
+        self.live = Live(get_renderable=self._render, console=console,
+                         refresh_per_second=refresh_per_second, transient=False)
+
+    def _render(self):
+        grid = Table.grid(expand=True, padding=(0, 1))
+        for _ in self.keys:
+            grid.add_column(ratio=1)
+        with self.lock:
+            panels = []
+            for key in self.keys:
+                # 回答开始前显示思考过程
+                if self.texts[key]:
+                    text, style = "".join(self.texts[key]), ""
+                else:
+                    text, style = "".join(self.reasoning[key]), "bright_blue"
+                lines = text.splitlines()[-PANEL_TAIL_LINES:]
+                panels.append(Panel(Text("\n".join(lines), style=style), title=key, border_style="cyan"))
+        grid.add_row(*panels)
+        return grid
+
+    def feed(self, key, content, is_reasoning=False):
+        with self.lock:
+            (self.reasoning if is_reasoning else self.texts)[key].append(content)
+
+    def __enter__(self):
+        self.live.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.live.stop()
@@ -0,0 +1,266 @@
+import argparse
+import glob
+import json
+import os
+import re
+import time
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Dict, List, Optional, Set, Tuple
+
+# 中日韩字符片段和字母数字片段分别按相邻二字切分，支持查询单词的任意部分（如 gpt 匹配 chatgpt）
+_CJK_RUN_RE = re.compile(r'[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff\uac00-\ud7af]+')
+_WORD_RE = re.compile(r'[0-9a-z]+')
+# 内存中最多缓存的索引段（天）数，按最近使用淘汰
+SEGMENT_CACHE_DAYS = 7
+# 索引切分方式的版本，加载旧版本的索引段时按已保存的记录重新建立倒排表
+INDEX_VERSION = 2
+_LOG_FILE_RE = re.compile(r'_(\d{8})\.log$')
+_LOG_ROW_RE = re.compile(r'^\| \d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2} \|')
+_LOG_INPUT_PREFIX = "| 输入内容: "
+
+# 日志表格中各列对应的记录字段
+RECORD_FIELDS = ("time", "ip", "device", "os", "browser", "device_model", "api", "model")
+
+
+def tokenize(text: str) -> Set[str]:
+    """将文本切分为索引词：中文片段和英文数字片段均按相邻二字切分，单字片段保留单字"""
+    text = text.lower()
+    terms = set()
+    for run in _CJK_RUN_RE.findall(text) + _WORD_RE.findall(text):
+        if len(run) == 1:
+            terms.add(run)
+        else:
+            terms.update(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+class IndexSegment:
+    """单日的倒排索引段：记录列表 + 索引词到记录下标的倒排表"""
+    def __init__(self, docs: Optional[List[Dict]] = None, postings: Optional[Dict[str, List[int]]] = None):
+        self.docs = docs or []
+        self.postings = postings or {}
+
+    def add(self, record: Dict):
+        doc_id = len(self.docs)
+        self.docs.append(record)
+        for term in tokenize(record["text"]):
+            self.postings.setdefault(term, []).append(doc_id)
+
+    def copy(self) -> 'IndexSegment':
+        """复制索引段，在副本上追加记录不影响原索引段"""
+        return IndexSegment(list(self.docs), {term: list(ids) for term, ids in self.postings.items()})
+
+    def search(self, terms: Set[str], phrases: List[str]) -> List[Dict]:
+        """按索引词求交集得到候选记录，再逐条确认包含全部查询片段；没有可用索引词时逐条扫描"""
+        if not terms:
+            return [doc for doc in self.docs if _matches(doc, phrases)]
+        lists = []
+        for term in terms:
+            ids = self.postings.get(term)
+            if not ids:
+                return []
+            lists.append(ids)
+        lists.sort(key=len)
+        candidates = set(lists[0])
+        for ids in lists[1:]:
+            candidates.intersection_update(ids)
+            if not candidates:
+                return []
+        return [self.docs[i] for i in sorted(candidates) if _matches(self.docs[i], phrases)]
+
+    @classmethod
+    def load(cls, path: str) -> 'IndexSegment':
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get("version") == INDEX_VERSION:
+            return cls(data["docs"], data["postings"])
+        segment = cls()
+        for record in data["docs"]:
+            segment.add(record)
+        return segment
+
+    def save(self, path: str):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"version": INDEX_VERSION, "docs": self.docs, "postings": self.postings}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+def _matches(record: Dict, phrases: List[str]) -> bool:
+    text = record["text"].lower()
+    return all(phrase in text for phrase in phrases)
+
+
+class SearchIndex:
+    def __init__(self, index_dir: str, log_dir: str):
+        """
+        初始化用户输入全文索引
+        :param index_dir: 索引段保存目录，每天一个 YYYYMMDD.json
+        :param log_dir: UserLogger 的日志目录，用于从文本日志重建索引
+        """
+        self.index_dir = index_dir
+        self.log_dir = log_dir
+        # 三把锁各自只保护一小段状态，读写磁盘时不持有 add() 使用的 pending_lock，避免搜索阻塞用户消息
+        self.pending_lock = Lock()
+        self.segment_lock = Lock()
+        self.merge_lock = Lock()  # 串行化合并与重建
+        self.pending: Dict[str, List[Dict]] = defaultdict(list)  # 尚未合并进索引段的新记录
+        self.merging: Dict[str, List[Dict]] = {}  # 正在合并的记录，合并完成前仍可被搜索到
+        self.segments: 'OrderedDict[str, IndexSegment]' = OrderedDict()  # 已加载的索引段缓存（LRU）
+        os.makedirs(self.index_dir, exist_ok=True)
+
+    def _segment_file(self, day: str) -> str:
+        return os.path.join(self.index_dir, f"{day}.json")
+
+    def add(self, record: Dict):
+        """添加一条用户输入记录（先进入待合并队列，由后台任务合并）"""
+        day = record["time"][:10].replace('-', '')
+        with self.pending_lock:
+            self.pending[day].append(record)
+
+    def _cache_segment(self, day: str, segment: IndexSegment):
+        with self.segment_lock:
+            self.segments[day] = segment
+            self.segments.move_to_end(day)
+            while len(self.segments) > SEGMENT_CACHE_DAYS:
+                self.segments.popitem(last=False)
+
+    def _get_segment(self, day: str) -> Optional[IndexSegment]:
+        """获取索引段，未缓存时在锁外从磁盘加载"""
+        with self.segment_lock:
+            segment = self.segments.get(day)
+            if segment is not None:
+                self.segments.move_to_end(day)
+                return segment
+        path = self._segment_file(day)
+        if not os.path.exists(path):
+            return None
+        segment = IndexSegment.load(path)
+        self._cache_segment(day, segment)
+        return segment
+
+    def _pending_records(self, day: str) -> Tuple[List[Dict], List[Dict]]:
+        """返回该日正在合并的记录和待合并的记录"""
+        with self.pending_lock:
+            return list(self.merging.get(day, [])), list(self.pending.get(day, []))
+
+    def merge_pending(self):
+        """将待合并记录写入对应日期的索引段"""
+        with self.merge_lock:
+            with self.pending_lock:
+                self.merging, self.pending = dict(self.pending), defaultdict(list)
+            for day, records in list(self.merging.items()):
+                try:
+                    # 在副本上追加，写盘成功后才替换缓存，失败时缓存中的索引段保持不变
+                    segment = self._get_segment(day)
+                    segment = segment.copy() if segment else IndexSegment()
+                    for record in records:
+                        segment.add(record)
+                    segment.save(self._segment_file(day))
+                    with self.pending_lock:
+                        self._cache_segment(day, segment)
+                        self.merging.pop(day, None)
+                except Exception as e:
+                    with self.pending_lock:
+                        self.pending[day][:0] = records
+                        self.merging.pop(day, None)
+                    print(f"合并搜索索引失败: {str(e)}")
+
+    def search(self, query: str, days: int = 30, limit: int = 100) -> List[Dict]:
+        """搜索最近 days 天内包含查询内容的记录（多个词以空格分隔，需同时包含），按时间倒序"""
+        phrases = [p for p in query.lower().split() if p]
+        if not phrases:
+            return []
+        # 单个字符不在二元组索引中，只能依靠逐条匹配
+        terms = {t for phrase in phrases for t in tokenize(phrase) if len(t) > 1}
+        today = datetime.now()
+        results = []
+        for offset in range(days):
+            day = (today - timedelta(days=offset)).strftime("%Y%m%d")
+            # 先取待合并记录再取索引段：期间合并完成时，正在合并的记录已在索引段末尾，按 (时间, 内容) 去重
+            merging, pending = self._pending_records(day)
+            segment = self._get_segment(day)
+            if segment and merging:
+                tail = {(r["time"], r["text"]) for r in segment.docs[-len(merging):]}
+                merging = [r for r in merging if (r["time"], r["text"]) not in tail]
+            day_results = [r for r in merging + pending if _matches(r, phrases)]
+            if segment:
+                day_results = segment.search(terms, phrases) + day_results
+            results.extend(reversed(day_results))
+            if len(results) >= limit:
+                break
+        return results[:limit]
+
+    def rebuild(self) -> int:
+        """从 UserLogger 写入的文本日志重建全部索引段，返回记录条数"""
+        with self.merge_lock:
+            records = []
+            for log_file in glob.glob(os.path.join(self.log_dir, "*.log")):
+                if _LOG_FILE_RE.search(log_file):
+                    records.extend(parse_log_file(log_file))
+            records.sort(key=lambda r: r["time"])
+            segments: Dict[str, IndexSegment] = defaultdict(IndexSegment)
+            for record in records:
+                segments[record["time"][:10].replace('-', '')].add(record)
+            for path in glob.glob(os.path.join(self.index_dir, "*.json")):
+                os.remove(path)
+            for day, segment in segments.items():
+                segment.save(self._segment_file(day))
+            with self.segment_lock:
+                self.segments = OrderedDict()
+            # 待合并记录先写入文本日志再加入队列，已被重建读到的不再重复合并
+            indexed = {(r["time"], r["text"]) for r in records}
+            with self.pending_lock:
+                for day in list(self.pending):
+                    self.pending[day] = [r for r in self.pending[day]
+                                         if (r["time"], r["text"]) not in indexed]
+        return len(records)
+
+
+def parse_log_file(log_file: str) -> List[Dict]:
+    """解析 UserLogger 写入的表格日志，返回记录列表"""
+    records = []
+    current = None
+    with open(log_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if _LOG_ROW_RE.match(line):
+                columns = [c.strip() for c in line.split('|')[1:-1]]
+                current = dict(zip(RECORD_FIELDS, columns))
+            elif line.startswith(_LOG_INPUT_PREFIX) and current:
+                current["text"] = line[len(_LOG_INPUT_PREFIX):]
+                records.append(current)
+                current = None
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="搜索历史用户输入")
+    parser.add_argument("query", nargs="?", help="搜索内容，多个词以空格分隔")
+    parser.add_argument("--days", type=int, default=30, help="搜索最近多少天（默认30）")
+    parser.add_argument("--limit", type=int, default=100, help="最多返回多少条（默认100）")
+    parser.add_argument("--log-dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs"),
+                        help="日志目录（默认为脚本目录下的logs）")
+    parser.add_argument("--rebuild", action="store_true", help="从文本日志重建索引")
+    args = parser.parse_args()
+
+    index = SearchIndex(os.path.join(args.log_dir, "index"), args.log_dir)
+    if args.rebuild:
+        start = time.time()
+        count = index.rebuild()
+        print(f"索引重建完成，共 {count} 条记录，用时 {time.time() - start:.2f} 秒")
+    if not args.query:
+        return
+    start = time.time()
+    results = index.search(args.query, days=args.days, limit=args.limit)
+    elapsed = (time.time() - start) * 1000
+    for r in results:
+        print(f"{r['time']} | {r['ip']} | {r['device']} {r['os']} {r['browser']} {r['device_model']} | "
+              f"{r['api']} {r['model']} | {r['text']}")
+    print(f"共 {len(results)} 条结果，用时 {elapsed:.1f} 毫秒")
+
+
+if __name__ == "__main__":
+    main()
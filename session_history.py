@@ -0,0 +1,144 @@
+import sys
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+from token_usage import estimate_tokens
+
+# 最近多少轮对话保持未压缩状态（一轮 = 用户消息 + 助手回复）
+HOT_TURNS = 2
+# 短于该字节数的消息压缩收益很小，直接保留原文
+MIN_COMPRESS_BYTES = 256
+COMPRESS_LEVEL = 6
+
+
+class MessageRecord:
+    """单条对话消息的紧凑存储，较旧的消息以zlib压缩后的字节保存，token数在追加时估算一次"""
+    __slots__ = ('role', 'payload', 'compressed', 'tokens')
+
+    def __init__(self, role: str, content: str):
+        self.role = role
+        self.payload = content
+        self.compressed = False
+        self.tokens = estimate_tokens(content)
+
+    @property
+    def content(self) -> str:
+        if self.compressed:
+            return zlib.decompress(self.payload).decode('utf-8')
+        return self.payload
+
+    def compress(self) -> bool:
+        """压缩消息内容，返回是否实际压缩"""
+        if self.compressed:
+            return False
+        raw = self.payload.encode('utf-8')
+        if len(raw) < MIN_COMPRESS_BYTES:
+            return False
+        packed = zlib.compress(raw, COMPRESS_LEVEL)
+        if len(packed) >= len(raw):
+            return False
+        self.payload = packed
+        self.compressed = True
+        return True
+
+    @property
+    def nbytes(self) -> int:
+        """估算该消息占用的内存字节数"""
+        return sys.getsizeof(self) + sys.getsizeof(self.payload)
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"role": self.role, "content": self.content}
+
+
+class SessionHistory:
+    """
+    会话的对话历史
+    首条为系统提示词，最近 HOT_TURNS 轮保持原文，更早的消息在追加时透明压缩，
+    仅在构造下一次请求（as_messages）时解压
+    历史只在末尾追加，删除只发生在开头（整轮丢弃）或末尾（未得到回复的提问），
+    保证相邻两次请求的前缀一致，便于命中API的前缀缓存
+    """
+    def __init__(self, system_prompt: str, hot_turns: int = HOT_TURNS):
+        self.hot_turns = hot_turns
+        self.records: List[MessageRecord] = [MessageRecord("system", system_prompt)]
+        self._cold_upto = 1  # 该下标之前的消息均已检查过压缩
+        self._nbytes = self.records[0].nbytes
+        self._tokens = self.records[0].tokens
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def nbytes(self) -> int:
+        """当前历史占用的内存字节数（增量维护）"""
+        return self._nbytes
+
+    @property
+    def token_count(self) -> int:
+        """当前历史的估算token数（增量维护，无需解压）"""
+        return self._tokens
+
+    @property
+    def compressed_count(self) -> int:
+        return sum(1 for r in self.records if r.compressed)
+
+    def append(self, role: str, content: str):
+        record = MessageRecord(role, content)
+        self.records.append(record)
+        self._nbytes += record.nbytes
+        self._tokens += record.tokens
+        self._compress_until(len(self.records) - self.hot_turns * 2)
+
+    def reset(self):
+        """清空对话历史，只保留系统提示词"""
+        self.records = self.records[:1]
+        self._cold_upto = 1
+        self._nbytes = self.records[0].nbytes
+        self._tokens = self.records[0].tokens
+
+    def discard_unanswered(self):
+        """丢弃末尾未得到回复的用户消息，保持用户/助手消息交替（deepseek-reasoner 要求）"""
+        while len(self.records) > 1 and self.records[-1].role == "user":
+            self._remove(len(self.records) - 1)
+
+    def drop_oldest(self, count: int):
+        """丢弃系统提示词之后最早的 count 条消息"""
+        for _ in range(min(count, len(self.records) - 1)):
+            self._remove(1)
+
+    def _remove(self, index: int):
+        record = self.records.pop(index)
+        self._nbytes -= record.nbytes
+        self._tokens -= record.tokens
+        if index < self._cold_upto:
+            self._cold_upto = max(1, self._cold_upto - 1)
+
+    def freeze(self) -> int:
+        """压缩除系统提示词外的全部消息（内存紧张时使用），返回释放的字节数"""
+        before = self._nbytes
+        self._compress_until(len(self.records))
+        return before - self._nbytes
+
+    def _compress_until(self, end: int):
+        for record in self.records[self._cold_upto:end]:
+            before = record.nbytes
+            if record.compress():
+                self._nbytes += record.nbytes - before
+        self._cold_upto = max(self._cold_upto, end)
+
+    def prepare(self, skip: int = 0) -> Dict[int, Tuple[MessageRecord, Dict[str, str]]]:
+        """
+        提前解压消息（预热时使用），返回 {id(记录): (记录, 消息)}，可传给 as_messages 跳过解压
+        只包含已压缩的消息（未压缩的无需解压，不额外占用内存）
+        保留记录本身的引用以免id被复用；skip 为即将被裁剪、无需解压的最早消息数
+        """
+        records = list(self.records)
+        kept = records[:1] + records[1 + skip:]
+        return {id(r): (r, r.to_dict()) for r in kept if r.compressed}
+
+    def as_messages(self, prepared: Optional[Dict[int, Tuple[MessageRecord, Dict[str, str]]]] = None
+                    ) -> List[Dict[str, str]]:
+        """构造发送给API的消息列表，prepared 中已有的消息不再重复解压"""
+        if not prepared:
+            return [r.to_dict() for r in self.records]
+        return [prepared[id(r)][1] if id(r) in prepared else r.to_dict() for r in self.records]
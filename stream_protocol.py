@@ -0,0 +1,59 @@
+from typing import Any, List, Optional
+
+from socketio import packet as sio_packet
+
+# 紧凑协议的事件编号，与 templates/index.html 中的 EVENT_TYPES 保持一致
+EVENT_CODES = {
+    'system': 0,
+    'assistant_start': 1,
+    'assistant_content': 2,
+    'reasoning_start': 3,
+    'reasoning_content': 4,
+    'reasoning_end': 5,
+}
+
+# 紧凑协议使用的 Socket.IO 事件名（旧客户端继续监听 'message'）
+COMPACT_EVENT = 'm'
+COMPACT_PROTOCOL = 'compact'
+
+# 内容类事件在紧凑模式下合并发送的阈值
+COALESCE_MAX_CHARS = 256
+COALESCE_MAX_DELAY = 0.05  # 秒
+
+
+def wants_compact(auth) -> bool:
+    """根据连接时的auth参数判断客户端是否选择紧凑协议"""
+    return isinstance(auth, dict) and auth.get('protocol') == COMPACT_PROTOCOL
+
+
+def event_name(compact: bool) -> str:
+    """流式事件使用的 Socket.IO 事件名"""
+    return COMPACT_EVENT if compact else 'message'
+
+
+def encode_event(msg_type: str, content: str, compact: bool = False, seq: Optional[int] = None) -> Any:
+    """
+    将流式事件编码为发送负载
+    :param compact: False 时返回旧版 {'type', 'content'} 字典；True 时返回 [编号, 内容] 列表
+                    （不使用二进制：Socket.IO 的二进制附件需要额外的占位包，按帧计反而更大）
+    :param seq: 事件序号（用于断线重连后补发），为空时不携带
+    """
+    if not compact:
+        event = {'type': msg_type, 'content': content}
+        if seq is not None:
+            event['seq'] = seq
+        return event
+    frame: List[Any] = [EVENT_CODES[msg_type], content]
+    if seq is not None:
+        frame.append(seq)
+    return frame
+
+
+def packet_size(event: str, payload: Any) -> int:
+    """
+    事件在线路上的字节数：按 python-socketio 的实际编码计算完整的事件包（含事件名），
+    每个包另加 Engine.IO 的1字节类型前缀；不含WebSocket帧头和压缩
+    """
+    encoded = sio_packet.Packet(sio_packet.EVENT, data=[event, payload]).encode()
+    parts = encoded if isinstance(encoded, list) else [encoded]
+    return sum(len(part.encode('utf-8')) + 1 if isinstance(part, str) else len(part) for part in parts)
@@ -0,0 +1,152 @@
+import os
+import sys
+from threading import Lock
+
+from rich.console import Console, Group
+from rich.live import Live
+from rich.markdown import Markdown
+from rich.panel import Panel
+from rich.text import Text
+
+# 实时区域中思考过程面板最多显示的行数
+REASONING_TAIL_LINES = 8
+
+
+def split_finished_blocks(text):
+    """
+    将Markdown文本拆分为已完成的块和仍在输出的尾部
+    以代码块之外的空行作为块边界，未闭合的代码块整体留在尾部
+    """
+    boundary = 0
+    in_fence = False
+    pos = 0
+    for line in text.splitlines(keepends=True):
+        pos += len(line)
+        stripped = line.strip()
+        if stripped.startswith("```"):
+            in_fence = not in_fence
+            if not in_fence and line.endswith("\n"):
+                boundary = pos
+        elif not stripped and not in_fence and line.endswith("\n"):
+            boundary = pos
+    return text[:boundary], text[boundary:]
+
+
+class PlainStreamRenderer:
+    """非终端输出（如管道、重定向）：原样追加写入，不解析标记也不重绘"""
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.title = "AI"
+        self.section = None
+
+    def begin(self, title):
+        self.title = title
+
+    def feed(self, text, is_reasoning=False):
+        section = "reasoning" if is_reasoning else "answer"
+        if section != self.section:
+            header = "\n（思考中）\n" if is_reasoning else f"\n{self.title}: "
+            self.stream.write(header)
+            self.section = section
+        self.stream.write(text)
+
+    def finish(self):
+        if self.section is not None:
+            self.stream.write("\n")
+            self.stream.flush()
+        self.section = None
+
+
+class LiveStreamRenderer:
+    """
+    终端实时渲染：内容先写入缓冲区，由固定帧率的实时区域绘制
+    已完成的Markdown块打印到实时区域上方后不再重绘，思考过程与回答分区显示
+    """
+    def __init__(self, console, refresh_per_second=15):
+        self.console = console
+        self.refresh_per_second = refresh_per_second
+        self.lock = Lock()  # 只保护缓冲区；打印会触发实时区域重绘，必须在锁外进行
+        self.live = None
+        self.title = "AI"
+        self.reasoning = []
+        self.answer_tail = ""
+        self.answer_started = False
+
+    def begin(self, title):
+        self.title = title
+
+    def _start(self):
+        if self.live is None:
+            self.live = Live(
+                get_renderable=self._render,
+                console=self.console,
+                refresh_per_second=self.refresh_per_second,
+                vertical_overflow="visible",
+                transient=True
+            )
+            self.live.start()
+
+    def _render(self):
+        with self.lock:
+            parts = []
+            if self.reasoning and not self.answer_started:
+                lines = "".join(self.reasoning).splitlines()[-REASONING_TAIL_LINES:]
+                parts.append(Panel(Text("\n".join(lines), style="bright_blue"),
+                                   title="思考中", title_align="left", border_style="bright_blue"))
+            if self.answer_tail:
+                parts.append(Markdown(self.answer_tail))
+            return Group(*parts)
+
+    def _take_reasoning(self, output):
+        """思考结束后将完整思考过程打印一次，之后不再重绘"""
+        if self.reasoning:
+            output.append(Text("".join(self.reasoning), style="bright_blue"))
+            self.reasoning = []
+
+    def feed(self, text, is_reasoning=False):
+        self._start()
+        output = []  # 需要固定打印到实时区域上方的内容
+        with self.lock:
+            if is_reasoning:
+                if not self.reasoning:
+                    output.append("\n[bright_blue]（思考中）[/bright_blue]")
+                self.reasoning.append(text)
+            else:
+                if not self.answer_started:
+                    self._take_reasoning(output)
+                    output.append(f"\n[cyan]{self.title}:[/cyan]")
+                    self.answer_started = True
+                finished, self.answer_tail = split_finished_blocks(self.answer_tail + text)
+                if finished:
+                    output.append(Markdown(finished))
+        for renderable in output:
+            self.console.print(renderable)
+
+    def finish(self):
+        if self.live is None:
+            return
+        output = []
+        with self.lock:
+            self._take_reasoning(output)
+            if self.answer_tail:
+                output.append(Markdown(self.answer_tail))
+            self.answer_tail = ""
+            self.answer_started = False
+        self.live.stop()
+        self.live = None
+        for renderable in output:
+            self.console.print(renderable)
+
+
+def create_renderer(console: Console):
+    """
+    根据 CLI_RENDER_MODE 环境变量创建终端渲染器
+    auto（默认）: 终端中使用实时渲染，输出被重定向时原样追加
+    live / plain: 强制使用对应模式；legacy: 返回None，沿用逐块打印
+    """
+    mode = os.getenv("CLI_RENDER_MODE", "auto").lower()
+    if mode == "legacy":
+        return None
+    if mode == "plain" or (mode == "auto" and not console.is_terminal):
+        return PlainStreamRenderer()
+    return LiveStreamRenderer(console, refresh_per_second=int(os.getenv("CLI_RENDER_FPS", "15")))
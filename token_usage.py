@@ -0,0 +1,217 @@
+import json
+import os
+import re
+from collections import defaultdict
+from datetime import datetime
+from threading import Lock
+from typing import Dict, List, Optional
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:  # tiktoken 为可选依赖，缺失时使用字符数估算
+    _ENCODING = None
+
+# 模型单价（元/百万tokens），prompt_cached 为命中前缀缓存部分的输入单价，未列出的模型只统计token不计费
+MODEL_PRICES = {
+    "deepseek-chat": {"prompt": 2.0, "prompt_cached": 0.5, "completion": 8.0},
+    "deepseek-reasoner": {"prompt": 4.0, "prompt_cached": 1.0, "completion": 16.0},
+}
+
+# 统计维度：会话、IP（备注名）、API、模型、API+模型
+DIMENSIONS = ("session", "ip", "api", "model", "api_model")
+
+_CJK_RE = re.compile(r'[\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+
+def estimate_tokens(text: str) -> int:
+    """本地估算文本的token数：优先使用tiktoken，否则按中文约1字1token、其他约4字符1token估算"""
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _cached_tokens(usage) -> Optional[int]:
+    """
+    读取命中前缀缓存的输入token数，API未返回时为None
+    DeepSeek 使用 prompt_cache_hit_tokens，OpenAI 兼容接口使用 prompt_tokens_details.cached_tokens
+    """
+    hit = getattr(usage, "prompt_cache_hit_tokens", None)
+    if hit is not None:
+        return hit
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None) if details else None
+
+
+def normalize_usage(usage) -> Optional[Dict[str, int]]:
+    """将API返回的usage对象转换为统一的计数字典"""
+    if usage is None:
+        return None
+    details = getattr(usage, "completion_tokens_details", None)
+    cached_tokens = _cached_tokens(usage)
+    return {
+        "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+        "reasoning_tokens": (getattr(details, "reasoning_tokens", 0) or 0) if details else 0,
+        "cached_tokens": cached_tokens or 0,
+        "cache_reported": cached_tokens is not None,
+        "estimated": False,
+    }
+
+
+def estimate_usage(messages: List[Dict[str, str]], content: str, reasoning_content: str) -> Dict[str, int]:
+    """API未返回usage时，根据请求和回复文本估算token用量"""
+    reasoning_tokens = estimate_tokens(reasoning_content)
+    return {
+        "prompt_tokens": sum(estimate_tokens(m["content"]) for m in messages),
+        "completion_tokens": estimate_tokens(content) + reasoning_tokens,
+        "reasoning_tokens": reasoning_tokens,
+        "cached_tokens": 0,
+        "cache_reported": False,
+        "estimated": True,
+    }
+
+
+def _new_counter():
+    return {
+        "requests": 0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "reasoning_tokens": 0,
+        "cached_tokens": 0,
+        "cache_reported_prompt_tokens": 0,  # 返回了缓存命中字段的请求的输入token数，用于计算命中率
+        "estimated_requests": 0,
+        "latency_seconds": 0.0,
+        "cost": 0.0,
+    }
+
+
+def _with_hit_ratio(counter: Dict) -> Dict:
+    reported = counter.get("cache_reported_prompt_tokens", 0)
+    return {
+        **counter,
+        "cache_hit_ratio": round(counter.get("cached_tokens", 0) / reported, 4) if reported else None,
+    }
+
+
+class TokenUsageTracker:
+    def __init__(self, store_dir: str, daily_quota: int = 0):
+        """
+        初始化token用量统计器
+        :param store_dir: 统计文件保存目录，每天一个 usage_YYYYMMDD.json
+        :param daily_quota: 每个IP每日token上限，0表示不限制
+        """
+        self.store_dir = store_dir
+        self.daily_quota = daily_quota
+        self.lock = Lock()
+        self.day = datetime.now().strftime("%Y%m%d")
+        self.totals = self._empty_totals()
+        self.dirty = False
+        self._load()
+
+    @staticmethod
+    def _empty_totals():
+        return {dim: defaultdict(_new_counter) for dim in DIMENSIONS}
+
+    def _store_file(self, day: str) -> str:
+        return os.path.join(self.store_dir, f"usage_{day}.json")
+
+    def _load(self):
+        """加载当天已保存的统计（重启后继续累计，保证每日额度准确）"""
+        try:
+            store_file = self._store_file(self.day)
+            if os.path.exists(store_file):
+                with open(store_file, 'r', encoding='utf-8') as f:
+                    saved = json.load(f)
+                for dim in DIMENSIONS:
+                    for key, counter in saved.get(dim, {}).items():
+                        self.totals[dim][key].update(counter)
+        except Exception as e:
+            print(f"加载token用量统计失败: {str(e)}")
+
+    def _roll_day(self):
+        """跨天时先保存前一天的统计，再从零开始累计"""
+        today = datetime.now().strftime("%Y%m%d")
+        if today != self.day:
+            self._write()
+            self.day = today
+            self.totals = self._empty_totals()
+
+    def record(self, session_id: str, ip: str, api_name: str, model: str,
+               usage: Optional[Dict[str, int]], latency: float = 0.0):
+        """记录一次请求的token用量"""
+        if not usage:
+            return
+        price = MODEL_PRICES.get(model)
+        cost = 0.0
+        cached_tokens = usage.get("cached_tokens", 0)
+        if price:
+            cost = ((usage["prompt_tokens"] - cached_tokens) * price["prompt"] +
+                    cached_tokens * price.get("prompt_cached", price["prompt"]) +
+                    usage["completion_tokens"] * price["completion"]) / 1_000_000
+        keys = {
+            "session": session_id,
+            "ip": ip,
+            "api": api_name,
+            "model": model,
+            "api_model": f"{api_name}/{model}",
+        }
+        with self.lock:
+            self._roll_day()
+            for dim, key in keys.items():
+                counter = self.totals[dim][key]
+                counter["requests"] += 1
+                counter["prompt_tokens"] += usage["prompt_tokens"]
+                counter["completion_tokens"] += usage["completion_tokens"]
+                counter["reasoning_tokens"] += usage["reasoning_tokens"]
+                counter["cached_tokens"] += cached_tokens
+                if usage.get("cache_reported"):
+                    counter["cache_reported_prompt_tokens"] += usage["prompt_tokens"]
+                counter["estimated_requests"] += 1 if usage["estimated"] else 0
+                counter["latency_seconds"] += latency
+                counter["cost"] += cost
+            self.dirty = True
+
+    def ip_tokens_today(self, ip: str) -> int:
+        """获取IP今日已用的token总数"""
+        with self.lock:
+            self._roll_day()
+            counter = self.totals["ip"].get(ip)
+            if not counter:
+                return 0
+            return counter["prompt_tokens"] + counter["completion_tokens"]
+
+    def over_quota(self, ip: str) -> bool:
+        """判断IP今日用量是否已超出额度"""
+        return self.daily_quota > 0 and self.ip_tokens_today(ip) >= self.daily_quota
+
+    def snapshot(self, dimension: Optional[str] = None) -> Dict:
+        """获取当日统计，可只返回某个维度；cache_hit_ratio 为前缀缓存命中率，API未返回缓存字段时为None"""
+        with self.lock:
+            self._roll_day()
+            dims = [dimension] if dimension in DIMENSIONS else DIMENSIONS
+            return {
+                "day": self.day,
+                "daily_quota": self.daily_quota,
+                **{dim: {k: _with_hit_ratio(v) for k, v in self.totals[dim].items()} for dim in dims}
+            }
+
+    def flush(self):
+        """将统计写入本地文件（仅在有新数据时）"""
+        with self.lock:
+            if self.dirty:
+                self._write()
+
+    def _write(self):
+        try:
+            store_file = self._store_file(self.day)
+            tmp_file = store_file + ".tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({dim: self.totals[dim] for dim in DIMENSIONS}, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_file, store_file)
+            self.dirty = False
+        except Exception as e:
+            print(f"保存token用量统计失败: {str(e)}")
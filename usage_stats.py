@@ -0,0 +1,198 @@
+import base64
+import hashlib
+import json
+import math
+import os
+from collections import Counter
+from datetime import datetime
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+# 消息长度分布的分桶上限（字符数），最后一个桶收纳更长的消息
+LENGTH_BUCKETS = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class HyperLogLog:
+    """HyperLogLog 基数估计，2^p 个寄存器，标准误差约 1.04/sqrt(2^p)"""
+    def __init__(self, p: int = 12, registers: Optional[bytes] = None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(registers) if registers else bytearray(self.m)
+        # 调和和与零寄存器数在寄存器变化时增量维护，count 无需扫描全部寄存器
+        self._harmonic_sum = sum(2.0 ** -r for r in self.registers)
+        self._zeros = self.registers.count(0)
+
+    def add(self, value: str):
+        h = int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+        idx = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        old = self.registers[idx]
+        if rank > old:
+            self._harmonic_sum += 2.0 ** -rank - 2.0 ** -old
+            if old == 0:
+                self._zeros -= 1
+            self.registers[idx] = rank
+
+    def count(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / self._harmonic_sum
+        if estimate <= 2.5 * self.m and self._zeros:
+            # 小基数时使用线性计数修正
+            estimate = self.m * math.log(self.m / self._zeros)
+        return int(round(estimate))
+
+    def to_str(self) -> str:
+        return base64.b64encode(bytes(self.registers)).decode('ascii')
+
+    @classmethod
+    def from_str(cls, data: str, p: int = 12) -> 'HyperLogLog':
+        return cls(p, base64.b64decode(data))
+
+
+def _length_bucket(length: int) -> str:
+    for upper in LENGTH_BUCKETS:
+        if length <= upper:
+            return f"<={upper}"
+    return f">{LENGTH_BUCKETS[-1]}"
+
+
+class UsageStats:
+    def __init__(self, snapshot_file: str, hours_kept: int = 48, days_kept: int = 31):
+        """
+        初始化使用情况统计，随用户消息增量更新，无需重新扫描日志
+        :param snapshot_file: 定期保存统计快照的文件路径，重启后从中恢复
+        :param hours_kept: 按小时统计保留的小时数
+        :param days_kept: 按天统计（含每日独立IP/设备数）保留的天数
+        """
+        self.snapshot_file = snapshot_file
+        self.hours_kept = hours_kept
+        self.days_kept = days_kept
+        self.lock = Lock()
+        self.total_messages = 0
+        self.total_chars = 0
+        self.hourly = Counter()
+        self.daily = Counter()
+        self.counters = {name: Counter() for name in ("api", "model", "device_type", "os", "browser", "length")}
+        self.unique_ips = HyperLogLog()
+        self.unique_devices = HyperLogLog()
+        self.daily_ips: Dict[str, HyperLogLog] = {}
+        self.daily_devices: Dict[str, HyperLogLog] = {}
+        self.dirty = False
+        self._cached = None
+        self._closed_day_counts: Dict[str, Tuple[int, int]] = {}  # 已结束日期的独立IP/设备数，不再变化
+        self._load()
+
+    def record(self, ip: str, device_id: str, api_name: str, model: str,
+               device_info: Dict[str, str], length: int, when: Optional[datetime] = None):
+        """记录一条用户消息"""
+        when = when or datetime.now()
+        hour = when.strftime("%Y-%m-%d %H:00")
+        day = when.strftime("%Y-%m-%d")
+        with self.lock:
+            self.total_messages += 1
+            self.total_chars += length
+            self.hourly[hour] += 1
+            self.daily[day] += 1
+            self.counters["api"][api_name] += 1
+            self.counters["model"][model] += 1
+            self.counters["device_type"][device_info.get('type', '未知')] += 1
+            self.counters["os"][device_info.get('os', '未知')] += 1
+            self.counters["browser"][device_info.get('browser', '未知')] += 1
+            self.counters["length"][_length_bucket(length)] += 1
+            self.unique_ips.add(ip)
+            self.unique_devices.add(device_id)
+            self.daily_ips.setdefault(day, HyperLogLog()).add(ip)
+            self.daily_devices.setdefault(day, HyperLogLog()).add(device_id)
+            self._closed_day_counts.pop(day, None)
+            if len(self.hourly) > self.hours_kept or len(self.daily) > self.days_kept:
+                self._prune()
+            self.dirty = True
+            self._cached = None
+
+    def _prune(self):
+        """丢弃超出保留期的按小时/按天统计"""
+        for hour in sorted(self.hourly)[:-self.hours_kept]:
+            del self.hourly[hour]
+        for day in sorted(self.daily)[:-self.days_kept]:
+            del self.daily[day]
+            self.daily_ips.pop(day, None)
+            self.daily_devices.pop(day, None)
+            self._closed_day_counts.pop(day, None)
+
+    def _day_counts(self, day: str, today: str) -> Tuple[int, int]:
+        """某天的独立IP/设备数；已结束的日期计算一次后缓存"""
+        counts = self._closed_day_counts.get(day)
+        if counts is None:
+            ips, devices = self.daily_ips.get(day), self.daily_devices.get(day)
+            counts = (ips.count() if ips else 0, devices.count() if devices else 0)
+            if day < today:
+                self._closed_day_counts[day] = counts
+        return counts
+
+    def snapshot(self) -> Dict:
+        """获取统计结果（有新消息时才重新汇总，否则直接返回缓存）"""
+        with self.lock:
+            if self._cached is None:
+                today = datetime.now().strftime("%Y-%m-%d")
+                day_counts = {day: self._day_counts(day, today) for day in sorted(self.daily_ips)}
+                self._cached = {
+                    "total_messages": self.total_messages,
+                    "average_length": round(self.total_chars / self.total_messages, 1) if self.total_messages else 0,
+                    "unique_ips": self.unique_ips.count(),
+                    "unique_devices": self.unique_devices.count(),
+                    "messages_per_hour": dict(sorted(self.hourly.items())),
+                    "messages_per_day": dict(sorted(self.daily.items())),
+                    "unique_ips_per_day": {day: counts[0] for day, counts in day_counts.items()},
+                    "unique_devices_per_day": {day: counts[1] for day, counts in day_counts.items()},
+                    **{name: dict(counter.most_common()) for name, counter in self.counters.items()}
+                }
+            return self._cached
+
+    def _load(self):
+        """从快照文件恢复统计"""
+        try:
+            if not os.path.exists(self.snapshot_file):
+                return
+            with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.total_messages = data.get("total_messages", 0)
+            self.total_chars = data.get("total_chars", 0)
+            self.hourly.update(data.get("hourly", {}))
+            self.daily.update(data.get("daily", {}))
+            for name, values in data.get("counters", {}).items():
+                if name in self.counters:
+                    self.counters[name].update(values)
+            if data.get("unique_ips"):
+                self.unique_ips = HyperLogLog.from_str(data["unique_ips"])
+            if data.get("unique_devices"):
+                self.unique_devices = HyperLogLog.from_str(data["unique_devices"])
+            self.daily_ips = {day: HyperLogLog.from_str(v) for day, v in data.get("daily_ips", {}).items()}
+            self.daily_devices = {day: HyperLogLog.from_str(v) for day, v in data.get("daily_devices", {}).items()}
+        except Exception as e:
+            print(f"加载使用统计快照失败: {str(e)}")
+
+    def save(self):
+        """保存统计快照（仅在有新数据时）"""
+        with self.lock:
+            if not self.dirty:
+                return
+            data = {
+                "total_messages": self.total_messages,
+                "total_chars": self.total_chars,
+                "hourly": self.hourly,
+                "daily": self.daily,
+                "counters": self.counters,
+                "unique_ips": self.unique_ips.to_str(),
+                "unique_devices": self.unique_devices.to_str(),
+                "daily_ips": {day: hll.to_str() for day, hll in self.daily_ips.items()},
+                "daily_devices": {day: hll.to_str() for day, hll in self.daily_devices.items()},
+            }
+            try:
+                tmp_file = self.snapshot_file + ".tmp"
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_file, self.snapshot_file)
+                self.dirty = False
+            except Exception as e:
+                print(f"保存使用统计快照失败: {str(e)}")
@@ -4,26 +4,41 @@ import os
 import sys
 import time
 import re  # 添加re模块导入
-from threading import Event
+import argparse
+import queue
+import secrets
+from threading import Event, Lock, Timer
 import json
 from datetime import datetime
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, Response
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit
-from collections import defaultdict
+from collections import defaultdict, deque
 
 from dotenv import load_dotenv
 import openai
 from rich.console import Console
 from rich.panel import Panel
 from ip_mapper import IPMapper
+from usage_stats import UsageStats
+from search_index import SearchIndex
+from terminal_renderer import create_renderer
+from provider_compare import CompareView, PairPrinter, append_results, build_table, pair_key, run_compare
+from batch_runner import BatchRunner, load_items
+import stream_protocol
+from session_history import SessionHistory
+from prompt_builder import PromptBuilder
+from prewarm import Prewarmer
+import token_usage
+from token_usage import TokenUsageTracker
 
 app = Flask(__name__, 
     template_folder='templates',
     static_folder='templates/static'  # 添加static_folder配置
 )
 CORS(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
+# 长轮询传输对超过阈值的响应启用gzip/deflate压缩；紧凑协议合并后的大帧可从中获益
+socketio = SocketIO(app, cors_allowed_origins="*", http_compression=True, compression_threshold=512)
 
 # -----------------------------
 # 1. API 配置相关
@@ -63,6 +78,24 @@ API_CONFIGS = {
 # 默认API设置（如默认API不可用，则后续会自动选择第一个可用的API）
 CURRENT_API = "qwen"
 
+# 对话的系统提示词（作为所有请求的公共前缀以命中API的前缀缓存，保持固定，不要加入时间等动态内容）
+SYSTEM_PROMPT = "你是一个人工智能助手，请用简洁明了的中文回答。"
+
+# 每个会话保留的最近流式事件数量，断线重连后据此补发错过的内容
+STREAM_REPLAY_SIZE = 2048
+
+# 设置 STREAM_BYTES_LOG=1 时，每次网页端回答结束后打印实际发送的Socket.IO包字节数
+STREAM_BYTES_LOG = os.getenv("STREAM_BYTES_LOG") == "1"
+
+# 所有网页会话的对话历史内存上限（MB），超出后压缩或淘汰最久未活跃的会话
+SESSION_MEMORY_BUDGET = int(os.getenv("SESSION_MEMORY_BUDGET_MB", "200")) * 1024 * 1024
+
+# 对话历史的token上限，超出后一次性裁剪一半（整轮对齐），使前缀缓存长时间有效
+prompt_builder = PromptBuilder(token_budget=int(os.getenv("PROMPT_TOKEN_BUDGET", "48000")))
+
+# 网页端输入时预热请求路径，设置 PREWARM_ENABLED=0 关闭（仍统计首token时间，便于对比）
+prewarmer = Prewarmer(enabled=os.getenv("PREWARM_ENABLED", "1") != "0")
+
 def load_available_apis():
     """加载可用的API配置（检测.env中的API key）"""
     available = {}
@@ -89,13 +122,30 @@ if not AVAILABLE_APIS:
 if CURRENT_API not in AVAILABLE_APIS:
     CURRENT_API = next(iter(AVAILABLE_APIS))
 
+# 每个API共享一个客户端（内部维护连接池），避免每个会话各自持有一份
+api_clients = {}
+api_clients_lock = Lock()
+
+def get_api_client(api_name):
+    """获取指定API的共享客户端，首次使用时创建"""
+    with api_clients_lock:
+        client = api_clients.get(api_name)
+        if client is None:
+            client = openai.OpenAI(
+                api_key=AVAILABLE_APIS[api_name]["api_key"],
+                base_url=AVAILABLE_APIS[api_name]["base_url"]
+            )
+            api_clients[api_name] = client
+        return client
+
 
 # -----------------------------
 # 2. 流式输出打印类
 # -----------------------------
 class StreamPrinter:
     """流式输出处理器，负责缓存和逐块打印响应内容"""
-    def __init__(self, web_mode=False, sid=None, api_name=None):
+    def __init__(self, web_mode=False, sid=None, api_name=None, compact=False, sink=None, session=None,
+                 renderer=None):
         self.buffer = []
         self.is_first_chunk = True
         self.print_lock = Event()
@@ -105,11 +155,74 @@ class StreamPrinter:
         self.sid = sid
         self.api_name = api_name
         self.is_reasoning = False  # 添加思考状态标记
+        self.compact = compact  # 客户端是否使用紧凑协议
+        self.sink = sink  # 自定义事件接收函数 sink(msg_type, content)，如SSE接口
+        self.session = session  # 未指定sink时，通过该会话的Socket.IO连接发送（支持断线补发）
+        self.renderer = renderer  # 终端模式下的渲染器（见 terminal_renderer），为空时逐块打印
+        self.pending_type = None  # 紧凑模式下待合并发送的内容类型
+        self.pending_chunks = []
+        self.pending_lock = Lock()  # 流式线程与合并定时器共用
+        self.flush_timer = None  # 合并开始后 COALESCE_MAX_DELAY 秒触发发送
+        self.wire_bytes = 0  # 本次回答实际发送的字节数
+        self.legacy_wire_bytes = 0  # 同样内容使用旧版JSON协议的字节数
+
+    def _send(self, msg_type, content):
+        """按客户端协议编码并发送单个事件"""
+        if self.sink:
+            self.sink(msg_type, content)
+            return
+        payload = self.session.emit_stream_event(msg_type, content)
+        if not STREAM_BYTES_LOG:
+            return
+        self.wire_bytes += stream_protocol.packet_size(stream_protocol.event_name(self.compact), payload)
+        if self.compact:
+            legacy = stream_protocol.encode_event(msg_type, content, seq=payload[2])
+            self.legacy_wire_bytes += stream_protocol.packet_size(stream_protocol.event_name(False), legacy)
+        else:
+            self.legacy_wire_bytes = self.wire_bytes
+
+    def _flush_pending(self):
+        """发送紧凑模式下合并的内容（调用时需持有 pending_lock）"""
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        if self.pending_chunks:
+            self._send(self.pending_type, "".join(self.pending_chunks))
+        self.pending_type = None
+        self.pending_chunks = []
+
+    def _flush_due(self):
+        """合并等待达到 COALESCE_MAX_DELAY 时由定时器发送，流暂停时内容也不会滞留"""
+        with self.pending_lock:
+            self._flush_pending()
+
+    def _emit(self, msg_type, content):
+        """发送事件到网页；紧凑模式下将连续的内容块合并成较大的帧"""
+        with self.pending_lock:
+            if not self.compact or not msg_type.endswith('_content'):
+                self._flush_pending()
+                self._send(msg_type, content)
+                return
+            if self.pending_type != msg_type:
+                self._flush_pending()
+                self.pending_type = msg_type
+                self.flush_timer = Timer(stream_protocol.COALESCE_MAX_DELAY, self._flush_due)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+            self.pending_chunks.append(content)
+            if sum(len(c) for c in self.pending_chunks) >= stream_protocol.COALESCE_MAX_CHARS:
+                self._flush_pending()
 
     def stream_print(self, content, is_reasoning=False):
         """将内容缓存后逐块打印至终端或发送到网页"""
         if not content:
             return
+        if self.renderer is not None:
+            if self.is_first_chunk:
+                self.renderer.begin(API_CONFIGS[self.api_name]["display_name"] if self.api_name else "AI")
+                self.is_first_chunk = False
+            self.renderer.feed(content, is_reasoning)
+            return
         self.buffer.append(content)
         if self.print_lock.is_set():
             self.print_lock.clear()
@@ -117,7 +230,7 @@ class StreamPrinter:
                 display_name = API_CONFIGS[self.api_name]["display_name"] if self.api_name else "AI"
                 prefix = f"\n[cyan]{display_name}:[/cyan] "
                 if self.web_mode:
-                    socketio.emit('message', {'type': 'assistant_start', 'content': display_name}, room=self.sid)
+                    self._emit('assistant_start', display_name)
                 else:
                     console.print(prefix, end="")
                 self.is_first_chunk = False
@@ -125,7 +238,7 @@ class StreamPrinter:
             # 处理思考状态的开始
             if is_reasoning and not self.is_reasoning:
                 if self.web_mode:
-                    socketio.emit('message', {'type': 'reasoning_start', 'content': '（思考中）'}, room=self.sid)
+                    self._emit('reasoning_start', '（思考中）')
                 console.print("\n[bright_blue]（思考中）[/bright_blue]")
                 self.is_reasoning = True
             
@@ -133,7 +246,7 @@ class StreamPrinter:
                 chunk = self.buffer.pop(0)
                 if self.web_mode:
                     msg_type = 'reasoning_content' if is_reasoning else 'assistant_content'
-                    socketio.emit('message', {'type': msg_type, 'content': chunk}, room=self.sid)
+                    self._emit(msg_type, chunk)
                 
                 # 在终端中显示内容
                 lines = chunk.split('\n')
@@ -151,6 +264,18 @@ class StreamPrinter:
 
     def reset(self):
         """重置打印状态，结束当前流输出"""
+        if self.renderer is not None:
+            self.renderer.finish()
+            self.is_first_chunk = True
+            return
+        if self.web_mode:
+            with self.pending_lock:
+                self._flush_pending()
+            if self.wire_bytes:
+                print(f"[{self.sid}] 本次回答发送 {self.wire_bytes} 字节"
+                      f"（同样的合并帧使用旧版JSON协议为 {self.legacy_wire_bytes} 字节）")
+            self.wire_bytes = 0
+            self.legacy_wire_bytes = 0
         self.is_first_chunk = True
         if not self.last_chunk_ended_with_newline:
             if not self.web_mode:
@@ -248,37 +373,53 @@ def switch_model(choice, model_list):
 # -----------------------------
 # 4. API调用与流式响应处理
 # -----------------------------
+# 不支持 stream_options 参数的API地址（首次被拒绝后记录，之后不再携带）
+stream_usage_unsupported = set()
+
 def chat_stream(messages, printer, model="deepseek-chat", client=None):
     """
     发送对话消息至后端API，并以流式方式处理返回内容
     包含错误重试和异常处理（认证、网络、未知错误）
+    返回值中的 usage 优先取自API的流式用量，API不提供时使用本地估算；请求失败时包含 error
     """
     full_response = []
     reasoning_content = []
+    usage = None
     max_retries = 3
     retry_count = 0
     
     # 添加超时检测
     start_time = time.time()
     first_response_received = False
+    ttft = None
+    base_url = str(client.base_url)
 
     while retry_count < max_retries:
         try:
+            request_options = {}
+            if base_url not in stream_usage_unsupported:
+                request_options["stream_options"] = {"include_usage": True}
             for chunk in client.chat.completions.create(
                 model=model,
                 messages=messages,
                 temperature=0.7,
                 stream=True,
-                timeout=30
+                timeout=30,
+                **request_options
             ):
                 # 检查是否是第一个响应
                 if not first_response_received:
                     first_response_received = True
                     elapsed_time = time.time() - start_time
+                    ttft = elapsed_time
                     # 如果是 deepseek-reasoner 且超过10秒没有响应
                     if model == "deepseek-reasoner" and elapsed_time > 10:
                         raise TimeoutError("DeepSeek Reasoner 响应超时")
 
+                # 开启 include_usage 后，最后一个chunk携带本次请求的用量
+                if getattr(chunk, 'usage', None):
+                    usage = token_usage.normalize_usage(chunk.usage)
+
                 if not chunk.choices or len(chunk.choices) == 0:
                     continue
 
@@ -294,10 +435,17 @@ def chat_stream(messages, printer, model="deepseek-chat", client=None):
             break
         except TimeoutError as e:
             console.print(f"\n[red]❌ {str(e)}[/red]")
-            return {"reasoning_content": "", "content": ""}
+            return {"reasoning_content": "", "content": "", "error": str(e)}
         except openai.AuthenticationError as e:
             console.print(f"\n[red]❌ 认证失败，请检查 API Key 是否正确: {e}[/red]")
-            return {"reasoning_content": "", "content": ""}
+            return {"reasoning_content": "", "content": "", "error": f"认证失败: {e}"}
+        except openai.BadRequestError as e:
+            # 部分API不支持 stream_options，去掉该参数后重新请求
+            if "stream_options" in str(e) and base_url not in stream_usage_unsupported and not first_response_received:
+                stream_usage_unsupported.add(base_url)
+                continue
+            console.print(f"\n[red]❌ 请求参数错误: {e}[/red]")
+            return {"reasoning_content": "", "content": "", "error": f"请求参数错误: {e}"}
         except (openai.APIConnectionError, openai.APITimeoutError) as e:
             retry_count += 1
             if retry_count < max_retries:
@@ -306,19 +454,157 @@ def chat_stream(messages, printer, model="deepseek-chat", client=None):
                 time.sleep(wait_time)
             else:
                 console.print(f"\n[red]❌ 连接失败，请检查网络连接或稍后重试: {e}[/red]")
-                return {"reasoning_content": "", "content": ""}
+                return {"reasoning_content": "", "content": "", "error": f"连接失败: {e}"}
         except Exception as e:
             console.print(f"\n[red]❌ 发生未知错误: {str(e)} - {type(e)}[/red]")
-            return {"reasoning_content": "", "content": ""}
+            return {"reasoning_content": "", "content": "", "error": f"未知错误: {e}"}
 
+    reasoning_text = "".join(reasoning_content)
+    content_text = "".join(full_response)
+    if usage is None:
+        usage = token_usage.estimate_usage(messages, content_text, reasoning_text)
     return {
-        "reasoning_content": "".join(reasoning_content),
-        "content": "".join(full_response)
+        "reasoning_content": reasoning_text,
+        "content": content_text,
+        "usage": usage,
+        "latency": time.time() - start_time,
+        "ttft": ttft
     }
 
 
 # -----------------------------
-# 5. 主交互逻辑
+# 5. 多API对比
+# -----------------------------
+def default_compare_pairs():
+    """默认对比组合：每个可用API的默认模型"""
+    return [(api_name, API_CONFIGS[api_name]["default_model"]) for api_name in AVAILABLE_APIS]
+
+def all_compare_pairs():
+    """所有可用API下的全部模型组合"""
+    return [(api_name, model) for api_name in AVAILABLE_APIS for model in API_CONFIGS[api_name]["models"]]
+
+def compare_results_file():
+    """对比结果追加保存的文件（COMPARE_RESULTS_FILE，扩展名为.csv时保存为CSV）"""
+    return os.getenv("COMPARE_RESULTS_FILE") or os.path.join(user_logger.log_dir, "compare_results.jsonl")
+
+def make_compare_chat_fn(session_id, ip_remark):
+    """生成对比模式下调用单个API/模型的函数，复用 chat_stream 并统计token用量"""
+    def chat_fn(api_name, model, messages, printer):
+        response = chat_stream(messages, printer, model, get_api_client(api_name))
+        usage_tracker.record(session_id, ip_remark, api_name, model,
+                             response.get("usage"), response.get("latency", 0.0))
+        return response
+    return chat_fn
+
+def run_cli_compare():
+    """终端对比模式：同时向多个API/模型发送同一问题，并排显示回答并输出对比表格"""
+    pairs = all_compare_pairs()
+    console.print("\n[cyan]可对比的API/模型：[/cyan]")
+    for idx, (api_name, model) in enumerate(pairs, start=1):
+        console.print(f"[blue]{idx}. {API_CONFIGS[api_name]['display_name']} - {model}[/blue]")
+    console.print("[dim]输入要对比的序号（用逗号分隔），直接回车则对比各API的默认模型[/dim]")
+    console.print("[bold green]序号:[/bold green] ", end="")
+    try:
+        choice = input().strip()
+    except (EOFError, KeyboardInterrupt):
+        console.print("\n[yellow]已取消对比[/yellow]")
+        return
+    if choice:
+        try:
+            indexes = [int(idx) for idx in choice.replace('，', ',').split(',') if idx.strip()]
+        except ValueError:
+            indexes = []
+        if not indexes or any(not 1 <= idx <= len(pairs) for idx in indexes):
+            console.print(f"\n[red]❌ 无效的序号，请输入 1-{len(pairs)} 之间的序号[/red]")
+            return
+        selected = [pairs[idx - 1] for idx in indexes]
+    else:
+        selected = default_compare_pairs()
+    selected = list(dict.fromkeys(selected))
+    if not selected:
+        console.print("\n[red]❌ 没有可对比的API/模型[/red]")
+        return
+
+    prompt = get_multiline_input().strip()
+    if not prompt:
+        return
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": prompt}]
+    with CompareView(console, [pair_key(*pair) for pair in selected]) as view:
+        results = run_compare(selected, messages, make_compare_chat_fn("cli-compare", "本地终端"), on_delta=view.feed)
+    console.print(build_table(results))
+    console.print("[dim]* 表示token数为本地估算[/dim]")
+    results_file = compare_results_file()
+    append_results(results_file, results)
+    console.print(f"[dim]结果已追加到 {results_file}[/dim]")
+
+
+# -----------------------------
+# 6. 批量处理
+# -----------------------------
+def batch_chat(item):
+    """处理单个批量任务，复用 chat_stream 的API调用、重试和用量统计"""
+    api_name = item["api"]
+    model = item.get("model") or API_CONFIGS[api_name]["default_model"]
+    messages = item.get("messages") or [
+        {"role": "system", "content": item.get("system") or SYSTEM_PROMPT},
+        {"role": "user", "content": item["prompt"]}
+    ]
+    response = chat_stream(messages, PairPrinter(item["id"]), model, get_api_client(api_name))
+    usage_tracker.record("batch", "本地终端", api_name, model,
+                         response.get("usage"), response.get("latency", 0.0))
+    return response
+
+def run_batch_command(argv):
+    """
+    批量处理命令：python 对话demo.py batch 输入.jsonl 输出.jsonl [选项]
+    按API分别限制并发和请求速率，结果完成一条写入一条，中断后重新执行同一命令即可继续
+    """
+    parser = argparse.ArgumentParser(prog="对话demo.py batch", description="批量处理JSONL中的提示词")
+    parser.add_argument("input", help="输入JSONL文件，每行包含 prompt 或 messages，可选 id/api/model/system")
+    parser.add_argument("output", help="输出JSONL文件（成功结果追加写入，检查点为 输出文件.ckpt，失败任务写入 输出文件.failed）")
+    parser.add_argument("--api", default=CURRENT_API, choices=list(AVAILABLE_APIS), help="默认API")
+    parser.add_argument("--model", help="默认模型（不指定则使用API的默认模型）")
+    parser.add_argument("--concurrency", type=int, default=4, help="每个API的最大并发数（默认4）")
+    parser.add_argument("--rpm", type=int, default=0, help="每个API每分钟最多请求数，0为不限制（默认0）")
+    parser.add_argument("--retries", type=int, default=3, help="失败任务的最大重试次数（默认3）")
+    args = parser.parse_args(argv)
+    if args.concurrency < 1:
+        console.print("[red]❌ --concurrency 不能小于1[/red]")
+        return
+
+    try:
+        items = load_items(args.input, args.api, args.model)
+    except ValueError as e:
+        console.print(f"[red]❌ 输入文件格式错误: {str(e)}[/red]")
+        return
+    unknown = {item["api"] for item in items} - set(AVAILABLE_APIS)
+    if unknown:
+        console.print(f"[red]❌ 以下API未配置或不可用: {', '.join(sorted(unknown))}[/red]")
+        return
+    # API_CONFIGS 中可用 batch_concurrency / rate_limit_rpm 为单个API单独设置
+    apis = {item["api"] for item in items}
+    concurrency = {api: API_CONFIGS[api].get("batch_concurrency", args.concurrency) for api in apis}
+    invalid = sorted(api for api, value in concurrency.items() if not isinstance(value, int) or value < 1)
+    if invalid:
+        console.print(f"[red]❌ 以下API的 batch_concurrency 配置无效（应为不小于1的整数）: {', '.join(invalid)}[/red]")
+        return
+    runner = BatchRunner(
+        args.output,
+        batch_chat,
+        concurrency=concurrency,
+        rpm={api: API_CONFIGS[api].get("rate_limit_rpm", args.rpm) for api in apis},
+        max_retries=args.retries
+    )
+    summary = runner.run(items, console=console)
+    usage_tracker.flush()
+    console.print(f"\n[green]✓ 批量处理完成：共 {summary['total']} 条，跳过已完成 {summary['skipped']} 条，"
+                  f"本次处理 {summary['processed']} 条，失败 {summary['failed']} 条，用时 {summary['elapsed']} 秒[/green]")
+    if summary['failed']:
+        console.print(f"[yellow]失败的任务已写入 {runner.failed_file}，重新执行同一命令将重试这些任务[/yellow]")
+
+
+# -----------------------------
+# 7. 主交互逻辑
 # -----------------------------
 def main():
     global client, CURRENT_API, current_model
@@ -331,10 +617,7 @@ def main():
     try:
         # 初始化API客户端
         try:
-            client = openai.OpenAI(
-                api_key=AVAILABLE_APIS[CURRENT_API]["api_key"],
-                base_url=AVAILABLE_APIS[CURRENT_API]["base_url"]
-            )
+            client = get_api_client(CURRENT_API)
             console.print(f"\n[green]✓ 已连接到 {AVAILABLE_APIS[CURRENT_API]['display_name']} API[/green]")
         except Exception as e:
             console.print(f"\n[red]❌ 初始化客户端时发生错误: {str(e)}[/red]")
@@ -343,16 +626,14 @@ def main():
         # 使用默认对话模型
         current_model = API_CONFIGS[CURRENT_API]["default_model"]
         # 初始对话历史：系统设定角色 提示词
-        messages = [{
-            "role": "system",
-            "content": "你是一个人工智能助手，请用简洁明了的中文回答。"
-        }]
+        history = SessionHistory(SYSTEM_PROMPT)
 
         # 显示使用说明
         console.print(Panel.fit(
             "[bold yellow]AI 对话助手[/bold yellow]\n"
             "输入 [cyan]cl[/cyan] 清除记忆，输入 [cyan]q[/cyan] 退出\n"
             "输入 [cyan]m[/cyan] 查看当前API支持的模型列表，进入[cyan]模型选择模式[/cyan]（如果当前API支持）\n"
+            "输入 [cyan]c[/cyan] 进入[cyan]对比模式[/cyan]，同时向多个API/模型提问并对比速度\n"
             "直接输入数字 [cyan]1[/cyan]、[cyan]2[/cyan]、[cyan]3[/cyan]、[cyan]4[/cyan] 切换API服务\n"
             "\n切换API对应关系：\n"
             "  1 - DeepSeek\n"
@@ -362,7 +643,7 @@ def main():
             border_style="blue"
         ))
 
-        printer = StreamPrinter(api_name=CURRENT_API)
+        printer = StreamPrinter(api_name=CURRENT_API, renderer=create_renderer(console))
 
         while True:
             try:
@@ -376,7 +657,7 @@ def main():
                     break
                 # 清除记忆：保留系统消息并清屏
                 elif user_input == "cl":
-                    messages = messages[:1]
+                    history.reset()
                     clear_terminal()
                     console.print("[green]✓ 记忆已清除[/green]")
                     continue
@@ -385,6 +666,10 @@ def main():
                     model_list = print_model_list()
                     model_selection_mode = True
                     continue
+                # 对比模式：同时向多个API/模型发送同一问题
+                elif user_input == "c":
+                    run_cli_compare()
+                    continue
                 # 数字命令处理:
                 # 如果处于模型选择模式，则数字视为模型切换命令（仅限云雾智能API）
                 elif user_input.isdigit():
@@ -408,11 +693,9 @@ def main():
 
                         # 切换API后重新初始化客户端及模型
                         try:
-                            client = openai.OpenAI(
-                                api_key=AVAILABLE_APIS[CURRENT_API]["api_key"],
-                                base_url=AVAILABLE_APIS[CURRENT_API]["base_url"]
-                            )
+                            client = get_api_client(CURRENT_API)
                             current_model = API_CONFIGS[CURRENT_API]["default_model"]
+                            printer.api_name = CURRENT_API
                             console.print(f"\n[green]✓ 已切换到 {API_CONFIGS[CURRENT_API]['display_name']} API[/green]")
                             console.print("[dim]输入 'm' 查看模型列表[/dim]")
                             # 切换API后，如为云雾智能则打印该API支持的模型列表
@@ -422,18 +705,19 @@ def main():
                             console.print(f"\n[red]❌ 切换API失败: {str(e)}[/red]")
                         continue
 
-                # 普通对话内容，追加至消息列表后调用流式API
-                if current_model == "deepseek-reasoner":
-                    # 如果当前模型是 deepseek-reasoner，则清空消息列表，只保留 system message
-                    messages = messages[:1]
-                messages.append({"role": "user", "content": user_input})
-                response = chat_stream(messages, printer, current_model, client)
+                # 普通对话内容，追加至对话历史后调用流式API
+                prompt_builder.add_user_message(history, user_input)
+                response = chat_stream(prompt_builder.build(history), printer, current_model, client)
                 printer.reset()
+                usage_tracker.record("cli", "本地终端", CURRENT_API, current_model,
+                                     response.get("usage"), response.get("latency", 0.0))
 
                 if response["content"]:
-                    messages.append({"role": "assistant", "content": response["content"]})
+                    history.append("assistant", response["content"])
 
             except KeyboardInterrupt:
+                if printer.renderer is not None:
+                    printer.renderer.finish()
                 console.print("\n[yellow]🛑 操作已中断[/yellow]")
                 continue
 
@@ -507,12 +791,8 @@ def get_device_info(user_agent):
     
     return device_info
 
-@socketio.on('connect')
-def handle_connect(auth=None):
-    sid = request.sid
-    print(f"Client connected: {sid}")
-    
-    # 获取客户端IP
+def get_client_ip():
+    """获取当前请求的客户端IP（优先使用反向代理传递的真实IP）"""
     client_ip = (
         request.headers.get('X-Real-IP') or 
         request.headers.get('X-Forwarded-For') or 
@@ -524,70 +804,143 @@ def handle_connect(auth=None):
     )
     if isinstance(client_ip, str) and ',' in client_ip:
         client_ip = client_ip.split(',')[0].strip()
+    return client_ip
+
+@socketio.on('connect')
+def handle_connect(auth=None):
+    sid = request.sid
+    print(f"Client connected: {sid}")
+    auth = auth if isinstance(auth, dict) else {}
     
-    # 获取设备信息
-    user_agent = request.headers.get('User-Agent', '')
-    device_info = get_device_info(user_agent)
-    
-    # 检查是否存在相同IP的会话
-    existing_session = None
-    for existing_sid, session in user_sessions.items():
-        if session.client_ip == client_ip:
-            # 如果找到相同IP的会话且在30分钟内活跃，则复用该会话
-            if time.time() - session.last_active_time < 1800:  # 30分钟
-                existing_session = session
-                # 删除旧的会话
-                del user_sessions[existing_sid]
-                break
-    
-    if existing_session:
-        # 复用现有会话
-        user_sessions[sid] = existing_session
-        user_sessions[sid].update_active_time()
+    # 根据客户端保存的会话令牌恢复会话，令牌无效时创建新会话
+    token = auth.get('token')
+    session = user_sessions.get(token) if token else None
+    if session is None:
+        token, session = create_session()
     else:
-        # 创建新会话
-        user_sessions[sid] = UserSession(CURRENT_API, AVAILABLE_APIS[CURRENT_API])
-        user_sessions[sid].client_ip = client_ip
-        user_sessions[sid].device_info = device_info
+        session.client_ip = get_client_ip()
+        session.update_active_time()
+    with sessions_lock:
+        sid_tokens[sid] = token
+    # 协议以本次连接为准（复用的会话可能来自旧版页面）
+    session.compact_protocol = stream_protocol.wants_compact(auth)
+    emit('session', {'token': token, 'seq': session.stream_seq})
+    
+    # 补发断线期间错过的流式事件
+    last_seq = auth.get('last_seq')
+    if not isinstance(last_seq, int):
+        last_seq = None
+    if session.attach(sid, last_seq):
+        emit('message', {'type': 'system', 'content': '断线期间的部分回答内容已无法恢复'})
 
 @socketio.on('disconnect')
 def handle_disconnect():
     sid = request.sid
     print(f"Client disconnected: {sid}")
-    # 清理用户会话
-    if sid in user_sessions:
-        del user_sessions[sid]
+    # 保留会话以便重连后恢复，超时未活跃的会话由定期清理任务回收
+    with sessions_lock:
+        token = sid_tokens.pop(sid, None)
+        session = user_sessions.get(token)
+    if session:
+        session.detach(sid)
+
+def create_session(prefix=''):
+    """为当前请求创建新会话并生成会话令牌"""
+    token = f"{prefix}{secrets.token_urlsafe(16)}"
+    session = UserSession(CURRENT_API, AVAILABLE_APIS[CURRENT_API])
+    session.client_ip = get_client_ip()
+    session.device_info = get_device_info(request.headers.get('User-Agent', ''))
+    with sessions_lock:
+        user_sessions[token] = session
+    return token, session
+
+def get_socket_session():
+    """获取当前Socket.IO连接对应的会话令牌和会话"""
+    token = sid_tokens.get(request.sid)
+    session = user_sessions.get(token)
+    if session is None:
+        # 会话已过期或被淘汰：创建新会话并通知客户端更新令牌
+        token, session = create_session()
+        with sessions_lock:
+            sid_tokens[request.sid] = token
+        session.attach(request.sid)
+        emit('session', {'token': token, 'seq': session.stream_seq})
+    return token, session
 
 @socketio.on('user_message')
 def handle_message(data):
-    sid = request.sid
-    session = user_sessions[sid]
+    token, session = get_socket_session()
     message = data['message']
+    ip_remark = user_logger.ip_mapper.get_remark(session.client_ip)
+    
+    # 检查该IP今日token额度
+    if usage_tracker.over_quota(ip_remark):
+        emit('message', {'type': 'system', 'content': '今日对话额度已用完，请明天再试'})
+        return
     
+    printer = StreamPrinter(web_mode=True, sid=session.session_id, api_name=session.api_name,
+                            compact=session.compact_protocol, session=session)
+    run_chat_turn(token, session, message, printer)
+
+def run_chat_turn(token, session, message, printer):
+    """
+    执行一轮网页端对话（Socket.IO 与 HTTP 接口共用）
+    记录用户输入、更新对话历史、流式调用API并统计token用量
+    :param token: 会话令牌（仅用于内部查找，不写入日志和统计）
+    """
+    # 首token时间从本轮开始计时，包含取预热状态、构造消息和建立连接的时间，预热节省的部分才能体现出来
+    turn_start = time.time()
     # 记录用户输入，使用存储的客户端IP
     user_logger.log_user_input(
         ip_address=session.client_ip,
-        user_id=sid,
+        user_id=token,
         api_type=session.api_name,
         model=session.current_model,
         user_input=message
     )
     
-    if session.current_model == "deepseek-reasoner":
-        session.messages = session.messages[:1]
-    session.messages.append({"role": "user", "content": message})
+    # 对话历史只追加不重置（包括 deepseek-reasoner），保持请求前缀稳定
+    warm_state = prewarmer.take(token, session.api_name)
+    prompt_builder.add_user_message(session.history, message)
+    if warm_state:
+        trim = prompt_builder.recheck(session.history, warm_state.trim, warm_state.trim_tokens,
+                                      warm_state.trim_anchor)
+        messages = prompt_builder.build(session.history, warm_state.prepared, trim)
+    else:
+        messages = prompt_builder.build(session.history)
     
-    printer = StreamPrinter(web_mode=True, sid=sid, api_name=session.api_name)
-    response = chat_stream(session.messages, printer, session.current_model, session.client)
+    request_start = time.time()
+    response = chat_stream(messages, printer, session.current_model, session.client)
     printer.reset()
+    prewarmer.mark_used(session.api_name)
+    if response.get("ttft") is not None:
+        prewarmer.record_ttft(session.api_name, warm_state is not None,
+                              request_start - turn_start + response["ttft"])
+    usage_tracker.record(session.session_id, user_logger.ip_mapper.get_remark(session.client_ip),
+                         session.api_name, session.current_model,
+                         response.get("usage"), response.get("latency", 0.0))
     
     if response["content"]:
-        session.messages.append({"role": "assistant", "content": response["content"]})
+        session.history.append("assistant", response["content"])
+    session.update_active_time()
+    enforce_session_memory_budget(keep_token=token)
+    return response
+
+@socketio.on('typing')
+def handle_typing():
+    """用户正在输入：在后台预热当前API的连接和会话的对话历史"""
+    if not prewarmer.enabled:
+        return
+    token, session = get_socket_session()
+    # 服务端按会话节流，不依赖浏览器端的发送间隔
+    if not prewarmer.accept(token):
+        return
+    socketio.start_background_task(prewarmer.warm, token, session.api_name, session.current_model,
+                                   session.client, session.history, prompt_builder)
 
 @socketio.on('switch_api')
 def handle_switch_api(data):
-    sid = request.sid
-    session = user_sessions[sid]
+    _, session = get_socket_session()
     api_num = data['api_num']
     
     new_api = None
@@ -615,29 +968,268 @@ def handle_switch_api(data):
 
 @socketio.on('clear_chat')
 def handle_clear_chat():
-    sid = request.sid
-    session = user_sessions[sid]
+    _, session = get_socket_session()
     session.clear_messages()
 
 @socketio.on('switch_model')
 def handle_switch_model(data):
-    sid = request.sid
-    session = user_sessions[sid]
+    _, session = get_socket_session()
     model = data['model']
     if session.switch_model(model):
         emit('model_switched', {'model': model})
     else:
         emit('message', {'type': 'system', 'content': '无效的模型选择'})
 
+@socketio.on('compare')
+def handle_compare(data):
+    """
+    网页端对比模式：同时向多个API/模型发送同一问题
+    请求: {"message": "...", "pairs": 可选 [[api, model], ...]，默认对比各API的默认模型}
+    """
+    token, session = get_socket_session()
+    if not isinstance(data, dict) or not isinstance(data.get('message'), str) or not data['message']:
+        return
+    message = data['message']
+    raw_pairs = data.get('pairs') or []
+    if not isinstance(raw_pairs, list) or not all(
+            isinstance(pair, list) and len(pair) == 2 and all(isinstance(v, str) for v in pair)
+            for pair in raw_pairs):
+        emit('message', {'type': 'system', 'content': '对比参数格式错误，pairs 应为 [[API, 模型], ...]'})
+        return
+    ip_remark = user_logger.ip_mapper.get_remark(session.client_ip)
+    if usage_tracker.over_quota(ip_remark):
+        emit('message', {'type': 'system', 'content': '今日对话额度已用完，请明天再试'})
+        return
+    pairs = [(api_name, model) for api_name, model in raw_pairs
+             if api_name in AVAILABLE_APIS and model in API_CONFIGS[api_name]["models"]]
+    pairs = list(dict.fromkeys(pairs)) or default_compare_pairs()
+    
+    user_logger.log_user_input(
+        ip_address=session.client_ip,
+        user_id=token,
+        api_type='compare',
+        model=','.join(pair_key(*pair) for pair in pairs),
+        user_input=message
+    )
+    sid = request.sid
+    emit('compare_start', {'pairs': [pair_key(*pair) for pair in pairs]})
+    
+    def on_delta(key, content, is_reasoning):
+        socketio.emit('compare_content', {
+            'pair': key,
+            'type': 'reasoning_content' if is_reasoning else 'assistant_content',
+            'content': content
+        }, room=sid)
+    
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": message}]
+    results = run_compare(pairs, messages, make_compare_chat_fn(session.session_id, ip_remark), on_delta=on_delta)
+    append_results(compare_results_file(), results)
+    emit('compare_result', {'results': results})
+
 @socketio.on('get_models')
 def handle_get_models():
-    sid = request.sid
-    session = user_sessions[sid]
+    _, session = get_socket_session()
     emit('api_models', {
         'models': API_CONFIGS[session.api_name]["models"],
         'default_model': session.current_model
     })
 
+# -----------------------------
+# HTTP 流式接口（SSE）
+# -----------------------------
+# HTTP客户端通过该请求头携带会话令牌，首次请求时由服务端生成并在响应头中返回
+SESSION_TOKEN_HEADER = 'X-Session-Token'
+
+def get_http_session():
+    """根据请求头中的会话令牌获取会话，不存在时创建新会话"""
+    token = request.headers.get(SESSION_TOKEN_HEADER)
+    session = user_sessions.get(token) if token else None
+    if session is None:
+        token, session = create_session(prefix='http-')
+    session.update_active_time()
+    return token, session
+
+def format_sse(data, event=None):
+    """编码一条SSE消息"""
+    lines = f"event: {event}\n" if event else ""
+    return f"{lines}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# SSE响应头：禁止缓存以及反向代理缓冲，保证逐块下发
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'
+}
+
+@app.route('/v1/chat/stream', methods=['POST'])
+def http_chat_stream():
+    """
+    以SSE流式返回对话，事件与网页端 'message' 事件相同
+    请求体: {"message": "...", "api": 可选API名, "model": 可选模型名}
+    """
+    data = request.get_json(silent=True)
+    message = data.get('message') if isinstance(data, dict) else None
+    if not isinstance(message, str) or not message:
+        return jsonify({'error': '缺少必要参数'}), 400
+    token, session = get_http_session()
+    
+    api_name = data.get('api')
+    if api_name and api_name != session.api_name:
+        if not isinstance(api_name, str) or api_name not in AVAILABLE_APIS:
+            return jsonify({'error': '该API未配置或不可用'}), 400
+        session.switch_api(api_name, AVAILABLE_APIS[api_name])
+    if data.get('model') and (not isinstance(data['model'], str) or not session.switch_model(data['model'])):
+        return jsonify({'error': '无效的模型选择'}), 400
+    if usage_tracker.over_quota(user_logger.ip_mapper.get_remark(session.client_ip)):
+        return jsonify({'error': '今日对话额度已用完，请明天再试'}), 429
+    
+    events = queue.Queue()
+    
+    def run():
+        printer = StreamPrinter(web_mode=True, sid=session.session_id, api_name=session.api_name,
+                                sink=lambda msg_type, content: events.put({'type': msg_type, 'content': content}))
+        try:
+            response = run_chat_turn(token, session, message, printer)
+            events.put({'type': 'done', 'usage': response.get('usage')})
+        except Exception as e:
+            console.print(f"\n[red]❌ SSE对话失败: {str(e)}[/red]")
+            events.put({'type': 'error', 'content': str(e)})
+        finally:
+            events.put(None)
+    
+    # 与Socket.IO事件处理使用相同的并发模型；客户端断开后仍继续完成本轮对话并写入历史
+    socketio.start_background_task(run)
+    
+    def generate():
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            yield format_sse(event, event['type'] if event['type'] in ('done', 'error') else None)
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={**SSE_HEADERS, SESSION_TOKEN_HEADER: token})
+
+def resolve_api_for_model(model, preferred=None):
+    """查找支持该模型的可用API，优先使用 preferred"""
+    if preferred in AVAILABLE_APIS and model in API_CONFIGS[preferred]["models"]:
+        return preferred
+    for api_name in AVAILABLE_APIS:
+        if model in API_CONFIGS[api_name]["models"]:
+            return api_name
+    return None
+
+# OpenAI SDK 支持的对话参数；其余字段（如 top_k、enable_thinking）通过 extra_body 原样转发给API
+OPENAI_CHAT_PARAMS = {
+    'messages', 'audio', 'frequency_penalty', 'function_call', 'functions', 'logit_bias', 'logprobs',
+    'max_completion_tokens', 'max_tokens', 'metadata', 'modalities', 'n', 'parallel_tool_calls',
+    'prediction', 'presence_penalty', 'reasoning_effort', 'response_format', 'seed', 'service_tier',
+    'stop', 'store', 'stream', 'stream_options', 'temperature', 'tool_choice', 'tools', 'top_logprobs',
+    'top_p', 'user'
+}
+
+# 转发接口的用量统计会话名（该接口不保存对话历史）
+PASSTHROUGH_SESSION_ID = "openai-api"
+
+def split_chat_params(body):
+    """拆分请求体：SDK已知参数作为关键字参数，其余字段并入 extra_body"""
+    params = {}
+    extra = dict(body['extra_body']) if isinstance(body.get('extra_body'), dict) else {}
+    for key, value in body.items():
+        if key in ('model', 'extra_body'):
+            continue
+        if key in OPENAI_CHAT_PARAMS:
+            params[key] = value
+        else:
+            extra[key] = value
+    if extra:
+        params['extra_body'] = extra
+    return params
+
+def text_messages(messages):
+    """将消息内容统一为文本（多模态内容按JSON计），用于本地估算token"""
+    return [{"content": m.get("content") if isinstance(m.get("content"), str)
+             else json.dumps(m.get("content"), ensure_ascii=False)}
+            for m in messages if isinstance(m, dict)]
+
+@app.route('/v1/chat/completions', methods=['POST'])
+def openai_chat_completions():
+    """兼容OpenAI格式的转发接口，按模型名路由到对应API，使用共享客户端，与网页端共用额度和用量统计"""
+    body = request.get_json(silent=True) or {}
+    model = body.get('model') or API_CONFIGS[CURRENT_API]["default_model"]
+    api_name = resolve_api_for_model(model, request.headers.get('X-API-Name') or CURRENT_API)
+    if api_name is None:
+        return jsonify({'error': {'message': f'不支持的模型: {model}'}}), 404
+    if not isinstance(body.get('messages'), list) or not body['messages']:
+        return jsonify({'error': {'message': '缺少必要参数: messages'}}), 400
+    ip_remark = user_logger.ip_mapper.get_remark(get_client_ip())
+    if usage_tracker.over_quota(ip_remark):
+        return jsonify({'error': {'message': '今日对话额度已用完，请明天再试'}}), 429
+    
+    client = get_api_client(api_name)
+    base_url = str(client.base_url)
+    params = split_chat_params(body)
+    stream = bool(body.get('stream'))
+    # 流式请求总是要求API返回用量用于统计；客户端未要求时不转发仅含用量的chunk
+    client_stream_options = body.get('stream_options') if isinstance(body.get('stream_options'), dict) else {}
+    forward_usage = bool(client_stream_options.get('include_usage'))
+    if stream and base_url not in stream_usage_unsupported:
+        params['stream_options'] = {**client_stream_options, 'include_usage': True}
+    start = time.time()
+    
+    try:
+        try:
+            response = client.chat.completions.create(model=model, **params)
+        except openai.BadRequestError as e:
+            # 部分API不支持 stream_options，去掉该参数后重新请求（客户端自己要求的除外）
+            if not stream or forward_usage or "stream_options" not in str(e):
+                raise
+            stream_usage_unsupported.add(base_url)
+            params.pop('stream_options', None)
+            response = client.chat.completions.create(model=model, **params)
+    except openai.APIStatusError as e:
+        return jsonify({'error': {'message': str(e)}}), e.status_code
+    except (openai.APIConnectionError, openai.APITimeoutError) as e:
+        return jsonify({'error': {'message': str(e)}}), 502
+    except (TypeError, ValueError) as e:
+        # SDK 对参数类型/取值的校验错误
+        return jsonify({'error': {'message': f'请求参数错误: {e}'}}), 400
+    
+    def record_usage(usage, content, reasoning):
+        if usage is None:
+            usage = token_usage.estimate_usage(text_messages(body['messages']), content, reasoning)
+        usage_tracker.record(PASSTHROUGH_SESSION_ID, ip_remark, api_name, model, usage, time.time() - start)
+    
+    if not stream:
+        message = response.choices[0].message if response.choices else None
+        record_usage(token_usage.normalize_usage(response.usage),
+                     getattr(message, 'content', None) or "",
+                     getattr(message, 'reasoning_content', None) or "")
+        return jsonify(response.model_dump(exclude_none=True))
+    
+    def generate():
+        usage = None
+        content = []
+        reasoning = []
+        try:
+            for chunk in response:
+                if getattr(chunk, 'usage', None):
+                    usage = token_usage.normalize_usage(chunk.usage)
+                    if not chunk.choices and not forward_usage:
+                        continue
+                if chunk.choices:
+                    delta = chunk.choices[0].delta
+                    content.append(getattr(delta, 'content', None) or "")
+                    reasoning.append(getattr(delta, 'reasoning_content', None) or "")
+                yield f"data: {chunk.model_dump_json(exclude_none=True)}\n\n"
+        except Exception as e:
+            yield format_sse({'error': {'message': str(e)}})
+        finally:
+            # 客户端中途断开时同样计入用量
+            record_usage(usage, "".join(content), "".join(reasoning))
+        yield "data: [DONE]\n\n"
+    
+    return Response(generate(), mimetype='text/event-stream', headers=SSE_HEADERS)
+
 # -----------------------------
 # 用户会话管理
 # -----------------------------
@@ -645,33 +1237,75 @@ class UserSession:
     def __init__(self, api_name, api_config):
         self.api_name = api_name
         self.current_model = api_config["default_model"]
-        self.messages = [{
-            "role": "system",
-            "content": "你是一个人工智能助手，请用简洁明了的中文回答。"
-        }]
-        self.client = openai.OpenAI(
-            api_key=api_config["api_key"],
-            base_url=api_config["base_url"]
-        )
+        self.history = SessionHistory(SYSTEM_PROMPT)
+        # 对外展示和统计用的会话编号；会话令牌是恢复会话的凭据，不能出现在日志和接口中
+        self.session_id = secrets.token_hex(6)
         self.client_ip = None
         self.device_info = None
+        self.compact_protocol = False  # 是否使用紧凑的流式事件协议
+        self.sid = None  # 当前绑定的Socket.IO连接，断线期间为None
+        self.stream_events = deque(maxlen=STREAM_REPLAY_SIZE)  # (序号, 类型, 内容) 重放缓冲区
+        self.stream_seq = 0
+        self.stream_buffer_bytes = 0
+        self.stream_lock = Lock()
         self.last_active_time = time.time()  # 添加最后活动时间
 
+    @property
+    def client(self):
+        """当前API的共享客户端"""
+        return get_api_client(self.api_name)
+
     def update_active_time(self):
         """更新最后活动时间"""
         self.last_active_time = time.time()
 
+    def memory_usage(self):
+        """估算会话占用的内存字节数（对话历史和重放缓冲区）"""
+        return self.history.nbytes + self.stream_buffer_bytes
+
+    def emit_stream_event(self, msg_type, content):
+        """记录流式事件到重放缓冲区并发送给当前连接（断线期间只记录），返回发送的负载"""
+        with self.stream_lock:
+            if len(self.stream_events) == self.stream_events.maxlen:
+                self.stream_buffer_bytes -= len(self.stream_events[0][2])
+            self.stream_seq += 1
+            self.stream_events.append((self.stream_seq, msg_type, content))
+            self.stream_buffer_bytes += len(content)
+            return self._send_stream_event(self.stream_seq, msg_type, content)
+
+    def _send_stream_event(self, seq, msg_type, content):
+        payload = stream_protocol.encode_event(msg_type, content, self.compact_protocol, seq)
+        if self.sid is not None:
+            socketio.emit(stream_protocol.event_name(self.compact_protocol), payload, room=self.sid)
+        return payload
+
+    def attach(self, sid, last_seq=None):
+        """
+        绑定新的Socket.IO连接，并补发 last_seq 之后的流式事件
+        :return: 错过的事件已超出缓冲区、无法完整补发时返回True
+        """
+        with self.stream_lock:
+            self.sid = sid
+            if last_seq is None:
+                return False
+            missed = [event for event in self.stream_events if event[0] > last_seq]
+            for event in missed:
+                self._send_stream_event(*event)
+            return last_seq < self.stream_seq and (not missed or missed[0][0] > last_seq + 1)
+
+    def detach(self, sid):
+        """解除与已断开连接的绑定（会话已绑定到新连接时不处理）"""
+        with self.stream_lock:
+            if self.sid == sid:
+                self.sid = None
+
     def clear_messages(self):
-        self.messages = self.messages[:1]
+        self.history.reset()
         self.update_active_time()
 
     def switch_api(self, api_name, api_config):
         self.api_name = api_name
         self.current_model = api_config["default_model"]
-        self.client = openai.OpenAI(
-            api_key=api_config["api_key"],
-            base_url=api_config["base_url"]
-        )
         self.update_active_time()
 
     def switch_model(self, model_name):
@@ -681,8 +1315,47 @@ class UserSession:
             return True
         return False
 
-# 用户会话存储
+# 用户会话存储（会话令牌 -> 会话）
 user_sessions = {}
+# Socket.IO连接 -> 会话令牌
+sid_tokens = {}
+# 保护以上两个字典的增删和遍历（请求线程、定期清理线程会同时访问）
+sessions_lock = Lock()
+
+def session_memory_usage(token, session):
+    """会话占用的内存字节数，包括预热时解压的历史"""
+    return session.memory_usage() + prewarmer.memory_usage(token)
+
+def enforce_session_memory_budget(keep_token=None):
+    """
+    保证所有会话的内存占用不超过 SESSION_MEMORY_BUDGET
+    先丢弃预热时解压的历史，再从最久未活跃的会话开始压缩全部历史，仍超出时淘汰其中已断开连接的会话
+    :param keep_token: 正在处理请求的会话，不会被压缩或淘汰
+    """
+    with sessions_lock:
+        sessions = sorted(list(user_sessions.items()), key=lambda item: item[1].last_active_time)
+    total = sum(session_memory_usage(token, session) for token, session in sessions)
+    if total <= SESSION_MEMORY_BUDGET:
+        return
+    total -= prewarmer.release(keep_token)
+    if total <= SESSION_MEMORY_BUDGET:
+        return
+    for token, session in sessions:
+        if token == keep_token:
+            continue
+        total -= session.history.freeze()
+        if total <= SESSION_MEMORY_BUDGET:
+            return
+    for token, session in sessions:
+        # 仍连接的会话只压缩不淘汰，避免用户对话中途丢失历史
+        if token == keep_token or session.sid is not None:
+            continue
+        total -= session_memory_usage(token, session)
+        with sessions_lock:
+            user_sessions.pop(token, None)
+        print(f"会话内存超出上限，已淘汰会话: {session.session_id}")
+        if total <= SESSION_MEMORY_BUDGET:
+            return
 
 # -----------------------------
 # 日志记录相关
@@ -699,6 +1372,8 @@ class UserLogger:
         if not os.path.exists(self.log_dir):
             os.makedirs(self.log_dir)
         self.ip_mapper = IPMapper(os.path.join(self.log_dir, "ip_mapping.json"))
+        self.usage_stats = UsageStats(os.path.join(self.log_dir, "stats_snapshot.json"))
+        self.search_index = SearchIndex(os.path.join(self.log_dir, "index"), self.log_dir)
 
     def get_feature_hash(self, device_info, ip_address):
         """根据设备特征和IP生成唯一标识"""
@@ -756,6 +1431,16 @@ class UserLogger:
             'model': '未知'
         }
         
+        # 更新使用统计
+        self.usage_stats.record(
+            ip=ip_address,
+            device_id=self.get_feature_hash(device_info, ip_address),
+            api_name=api_type,
+            model=model,
+            device_info=device_info,
+            length=len(user_input)
+        )
+        
         # 处理输入中的换行符，确保日志格式正确
         user_input = user_input.replace('\n', ' ').replace('\r', '')
         
@@ -793,10 +1478,30 @@ class UserLogger:
                 f.flush()  # 立即写入磁盘
         except Exception as e:
             console.print(f"\n[red]❌ 写入日志失败: {str(e)}[/red]")
+            return
+        
+        # 加入全文索引，字段与日志表格各列一致
+        self.search_index.add({
+            "time": current_time,
+            "ip": ip_display,
+            "device": device_type,
+            "os": os_display,
+            "browser": device_info['browser'],
+            "device_model": model_display,
+            "api": api_type,
+            "model": model,
+            "text": user_input
+        })
 
 # 创建日志记录器实例
 user_logger = UserLogger()
 
+# token用量统计，与日志保存在同一目录
+usage_tracker = TokenUsageTracker(
+    user_logger.log_dir,
+    daily_quota=int(os.getenv("DAILY_TOKEN_QUOTA_PER_IP", "0"))
+)
+
 # 添加新的路由处理IP映射管理
 @app.route('/ip_mappings', methods=['GET'])
 def get_ip_mappings():
@@ -815,15 +1520,69 @@ def remove_ip_mapping(ip):
     user_logger.remove_ip_mapping(ip)
     return jsonify({'message': '删除成功'})
 
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    """使用情况统计（增量维护，不扫描日志）"""
+    return jsonify(user_logger.usage_stats.snapshot())
+
+@app.route('/admin/search', methods=['GET'])
+def search_user_inputs():
+    """全文搜索历史用户输入：?q=关键词&days=30&limit=100"""
+    query = request.args.get('q', '')
+    if not query.strip():
+        return jsonify({'error': '缺少必要参数'}), 400
+    start = time.time()
+    results = user_logger.search_index.search(
+        query,
+        days=request.args.get('days', 30, type=int),
+        limit=request.args.get('limit', 100, type=int)
+    )
+    return jsonify({'took_ms': round((time.time() - start) * 1000, 2), 'count': len(results), 'results': results})
+
+@app.route('/admin/usage', methods=['GET'])
+def get_usage():
+    """当日token用量统计（含前缀缓存命中率），可用 ?dim=api_model 只查看某个维度"""
+    return jsonify({**usage_tracker.snapshot(request.args.get('dim')), 'prompt_trims': prompt_builder.trim_count})
+
+@app.route('/admin/prewarm', methods=['GET'])
+def get_prewarm_stats():
+    """输入预热统计：各API预热与未预热请求的平均首token时间"""
+    return jsonify(prewarmer.snapshot())
+
+@app.route('/debug/sessions', methods=['GET'])
+def debug_sessions():
+    """按内存占用列出最大的会话"""
+    limit = request.args.get('limit', 20, type=int)
+    current_time = time.time()
+    with sessions_lock:
+        sessions = list(user_sessions.items())
+    usage = {token: session_memory_usage(token, session) for token, session in sessions}
+    sessions.sort(key=lambda item: usage[item[0]], reverse=True)
+    return jsonify({
+        'total_bytes': sum(usage.values()),
+        'budget_bytes': SESSION_MEMORY_BUDGET,
+        'session_count': len(sessions),
+        'sessions': [{
+            'session_id': session.session_id,
+            'connected': session.sid is not None,
+            'ip': user_logger.ip_mapper.get_remark(session.client_ip) if session.client_ip else None,
+            'api': session.api_name,
+            'model': session.current_model,
+            'messages': len(session.history),
+            'compressed_messages': session.history.compressed_count,
+            'tokens': session.history.token_count,
+            'bytes': usage[token],
+            'idle_seconds': int(current_time - session.last_active_time)
+        } for token, session in sessions[:limit]]
+    })
+
 def cleanup_inactive_sessions():
     """清理不活跃的会话"""
     current_time = time.time()
-    inactive_sids = []
-    for sid, session in user_sessions.items():
-        if current_time - session.last_active_time > 3600:  # 1小时未活动
-            inactive_sids.append(sid)
-    for sid in inactive_sids:
-        del user_sessions[sid]
+    with sessions_lock:
+        for token, session in list(user_sessions.items()):
+            if current_time - session.last_active_time > 3600:  # 1小时未活动
+                user_sessions.pop(token, None)
 
 # 在主循环中添加定期清理
 if __name__ == "__main__":
@@ -844,13 +1603,39 @@ if __name__ == "__main__":
     if CURRENT_API not in AVAILABLE_APIS:
         CURRENT_API = next(iter(AVAILABLE_APIS))
     
+    # python 对话demo.py cli：以终端交互模式运行
+    if len(sys.argv) > 1 and sys.argv[1] == "cli":
+        try:
+            main()
+        finally:
+            # 终端模式不启动定期保存线程，退出时写入本次的token用量
+            usage_tracker.flush()
+        sys.exit(0)
+    # python 对话demo.py batch 输入.jsonl 输出.jsonl：批量处理
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        run_batch_command(sys.argv[2:])
+        sys.exit(0)
+    
     def cleanup_task():
         while True:
             time.sleep(300)  # 每5分钟清理一次
-            cleanup_inactive_sessions()
+            try:
+                cleanup_inactive_sessions()
+            except Exception as e:
+                print(f"清理会话失败: {str(e)}")
+    
+    def usage_flush_task():
+        while True:
+            time.sleep(60)  # 每分钟保存一次token用量统计、使用统计快照，合并搜索索引，并释放过期的预热状态
+            usage_tracker.flush()
+            prewarmer.purge_expired()
+            user_logger.usage_stats.save()
+            user_logger.search_index.merge_pending()
     
     from threading import Thread
     cleanup_thread = Thread(target=cleanup_task, daemon=True)
     cleanup_thread.start()
+    usage_flush_thread = Thread(target=usage_flush_task, daemon=True)
+    usage_flush_thread.start()
     
     socketio.run(app, host='0.0.0.0', port=5005, debug=True, allow_unsafe_werkzeug=True) 
\ No newline at end of file